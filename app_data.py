@@ -0,0 +1,522 @@
+# coding: utf-8
+"""Data access of the apps.
+
+Process-wide caches of the database, the column stores and the static files
+of the apps, as well as the thread pool for blocking I/O. The data is created
+by import_db.py, which also defines where it is stored.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from import_db import (
+    automap_table, db_file, get_results_dataframes_from_disk,
+    no_tailcorrection_csv, os_cache_folder, os_url, parse_rdf_csv,
+    rdf_store, results_stores, store_column, store_index,
+    structure_folder, table_name, table_store, tailcorrection_csv,
+    units_table_name)
+
+# settings of the read-only connections used by the apps (see get_engine)
+read_poolclass = sqlalchemy.pool.SingletonThreadPool  # one connection/thread
+db_mmap_size = 256 * 1024**2  # bytes of the database file to memory-map
+db_cache_size = 64 * 1024  # KiB of page cache per connection
+# threads running blocking queries and file reads of the apps, see
+# run_in_executor; also bounds the number of pooled read connections
+io_max_workers = 4
+
+
+def file_stamp(*paths):
+    """Return a stamp that changes whenever one of the files changes.
+
+    Files are identified by inode, modification time and size, so that both
+    in-place modifications and replaced files are detected.
+    """
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_ino, st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+
+class FileCache(object):
+    """Process-wide cache for a value derived from files on disk.
+
+    The value is computed on first access and recomputed only when one of
+    the underlying files changes.
+    """
+
+    def __init__(self, loader, paths):
+        self.loader = loader
+        self.paths = paths
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._value = None
+
+    def get(self):
+        stamp = file_stamp(*self.paths)
+        with self._lock:
+            if self._value is None or stamp != self._stamp:
+                self._value = self.loader()
+                self._stamp = stamp
+            return self._value
+
+
+text_files = {}
+
+
+def get_text_file(path):
+    """Return content of a static text file (e.g. html or js) of the apps.
+
+    Files are read once per process and only read again when they change.
+    """
+    if path not in text_files:
+
+        def load(path=path):
+            with open(path, 'r') as f:
+                return f.read()
+
+        text_files[path] = FileCache(load, [path])
+    return text_files[path].get()
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return process-wide thread pool for blocking I/O of the apps.
+
+    The pool is created on first use, i.e. in each worker process forked by
+    the bokeh server.
+    """
+    global executor
+    from concurrent.futures import ThreadPoolExecutor
+
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=io_max_workers)
+    return executor
+
+
+def run_in_executor(doc, callback, function, *args, **kwargs):
+    """Run function(*args, **kwargs) without blocking the bokeh server.
+
+    Queries and file reads would otherwise stall all sessions of the process.
+    The function runs in the thread pool of get_executor and must not touch
+    models of the document. callback is then called with the future of the
+    result on the next tick of doc, i.e. holding the document lock.
+
+    Must be called from the thread of the IOLoop, e.g. from a callback.
+    """
+    from functools import partial
+    from tornado.ioloop import IOLoop
+
+    future = get_executor().submit(function, *args, **kwargs)
+    # add the callback from the thread of the IOLoop rather than the pool,
+    # since adding callbacks to a document sets the process-wide curdoc()
+    IOLoop.current().add_future(
+        future,
+        lambda future: doc.add_next_tick_callback(partial(callback, future)))
+    return future
+
+
+def connect_read_only():
+    """Open read-only connection to the database file."""
+    import sqlite3
+
+    return sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(db_file)),
+                           uri=True,
+                           check_same_thread=False)
+
+
+def set_read_pragmas(dbapi_connection, _connection_record):
+    """Tune new read-only connections for read-heavy serving."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.execute('PRAGMA mmap_size={}'.format(db_mmap_size))
+    # negative values are in KiB rather than pages
+    cursor.execute('PRAGMA cache_size=-{}'.format(db_cache_size))
+    cursor.close()
+
+
+def create_read_engine():
+    """Create engine with read-only connections to the database."""
+    # one connection for each thread of the pool and the IOLoop thread; with
+    # more threads, SingletonThreadPool would close connections in use
+    read_engine = sqlalchemy.create_engine('sqlite://',
+                                           creator=connect_read_only,
+                                           poolclass=read_poolclass,
+                                           pool_size=io_max_workers + 1)
+    sqlalchemy.event.listen(read_engine, 'connect', set_read_pragmas)
+    return read_engine
+
+
+read_engine = FileCache(create_read_engine, [db_file])
+
+
+def get_engine():
+    """Return engine for serving queries of the apps.
+
+    Connections are read-only and pooled per thread. When the database file
+    changes (e.g. after an import), a new engine is created. The old engine
+    is not disposed, since that would close connections other threads are
+    still using; its connections are closed once it is garbage collected.
+    """
+    return read_engine.get()
+
+
+table_model = FileCache(lambda: automap_table(get_engine()), [db_file])
+
+
+def get_table():
+    """Return model of the structures table.
+
+    The table is reflected once per process and only reflected again when
+    the database file changes.
+    """
+    return table_model.get()
+
+
+def load_columns(folder):
+    """Memory-map columns stored by pack_columns.
+
+    Returns an ordered dict of read-only arrays, a dict with the masks of
+    missing values and the index. All files belong to the version of the
+    store named by the index.
+    """
+    with open(store_index(folder), 'r') as f:
+        index = json.load(f)
+
+    version = index['version']
+    columns = collections.OrderedDict()
+    masks = {}
+    for i, label in enumerate(index['columns']):
+        columns[label] = np.load(store_column(folder, version, i),
+                                 mmap_mode='r')
+        if label in index['nulls']:
+            masks[label] = np.load(store_column(folder, version, i,
+                                                null=True),
+                                   mmap_mode='r')
+    return columns, masks, index
+
+
+def load_table_columns():
+    """Load structures table into a dict of read-only NumPy arrays.
+
+    Uses the memory-mapped columns created by pack_table, if present, so that
+    all server processes share the same pages of memory.
+    """
+    if os.path.exists(store_index(table_store)):
+        return load_columns(table_store)[0]
+
+    with get_engine().connect() as con:
+        df = pd.read_sql("SELECT * FROM {}".format(table_name), con)
+
+    columns = {}
+    for label in df:
+        values = np.array(df[label].values)
+        values.flags.writeable = False
+        columns[label] = values
+    return columns
+
+
+table_columns = FileCache(load_table_columns,
+                          [db_file, store_index(table_store)])
+
+
+def get_table_columns():
+    """Return in-memory copy of the structures table.
+
+    The table is loaded once per process and only loaded again when the
+    database file changes.
+    """
+    return table_columns.get()
+
+
+def load_units():
+    """Load units of the columns of the structures table."""
+    with get_engine().connect() as con:
+        # databases created before units were stored separately lack the table
+        if not con.dialect.has_table(con, units_table_name):
+            return {}
+        rows = con.execute('SELECT quantity, unit FROM {}'.format(
+            units_table_name)).fetchall()
+    return dict(rows)
+
+
+units_store = FileCache(load_units, [db_file])
+
+
+def get_units():
+    """Return units of the columns of the structures table."""
+    return units_store.get()
+
+
+def get_cif_path(filename):
+    from os.path import join, abspath
+    return abspath(join(structure_folder, filename))
+
+
+def get_cif_content_from_disk(filename):
+    """Load CIF content from disk."""
+    with open(get_cif_path(filename), 'r') as f:
+        content = f.read()
+    return content
+
+
+class ObjectStore(object):
+    """Structure files stored on an object store.
+
+    Files are fetched through a single pooled HTTP session and kept in a
+    bounded in-memory LRU cache. Files are also cached on disk together with
+    their ETag, so that they are only downloaded again when they changed.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 url,
+                 cache_folder=None,
+                 max_size=256,
+                 max_age=3600,
+                 timeout=10,
+                 pool_size=16):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url.rstrip('/')
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._memory = collections.OrderedDict()
+        self._prefetched = set()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Return content of file, fetching it only if necessary."""
+        with self._lock:
+            cached = self._memory.pop(filename, None)
+            if cached is not None and time.time() - cached[1] < self.max_age:
+                self._memory[filename] = cached
+                return cached[0]
+
+        content = self.fetch(filename)
+
+        with self._lock:
+            self._memory[filename] = (content, time.time())
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+        return content
+
+    def fetch(self, filename):
+        """Fetch file from object store, revalidating the disk cache.
+
+        Raises ValueError for file names that are not plain names of files
+        (e.g. containing a path), which could escape the cache folder.
+        """
+        if filename in ('', '.', '..') or os.path.basename(
+                filename) != filename:
+            raise ValueError("Invalid file name: {}".format(filename))
+
+        content, etag = self._read_cache(filename)
+
+        headers = {}
+        if content is not None and etag:
+            headers['If-None-Match'] = etag
+        response = self.session.get("{}/{}".format(self.url, filename),
+                                    headers=headers,
+                                    timeout=self.timeout)
+        if response.status_code == 304 and content is not None:
+            return content
+        response.raise_for_status()
+
+        content = response.text
+        self._write_cache(filename, content, response.headers.get('ETag'))
+        return content
+
+    def prefetch(self, filenames, max_workers=8):
+        """Fetch files concurrently in the background.
+
+        Files that were prefetched before are skipped.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self._lock:
+            filenames = [f for f in filenames if f not in self._prefetched]
+            self._prefetched.update(filenames)
+        if not filenames:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        for filename in filenames:
+            executor.submit(self._prefetch_one, filename)
+        executor.shutdown(wait=False)
+
+    def _prefetch_one(self, filename):
+        # errors would get lost in the executor of prefetch
+        try:
+            self.get(filename)
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Prefetching %s failed: %s", filename, exc)
+            # fetch again on the next prefetch
+            with self._lock:
+                self._prefetched.discard(filename)
+
+    def _cache_path(self, filename):
+        return os.path.join(self.cache_folder, filename)
+
+    def _read_cache(self, filename):
+        if self.cache_folder is None:
+            return None, None
+
+        path = self._cache_path(filename)
+        try:
+            with open(path, 'r') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None, None
+        try:
+            with open(path + '.etag', 'r') as f:
+                etag = f.read().strip()
+        except (IOError, OSError):
+            etag = None
+        return content, etag
+
+    def _write_cache(self, filename, content, etag):
+        if self.cache_folder is None:
+            return
+
+        path = self._cache_path(filename)
+        if not os.path.isdir(self.cache_folder):
+            os.makedirs(self.cache_folder)
+        # write to temporary file first to never expose partial files
+        tmp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+        if etag:
+            with open(tmp_path, 'w') as f:
+                f.write(etag)
+            os.rename(tmp_path, path + '.etag')
+        elif os.path.exists(path + '.etag'):
+            os.remove(path + '.etag')
+
+
+object_store = None
+object_store_lock = threading.Lock()
+
+
+def get_object_store():
+    """Return process-wide object store client for os_url."""
+    global object_store
+    with object_store_lock:
+        if object_store is None:
+            if not os_url:
+                raise ValueError(
+                    "Set STRUCTURES_URL to load structures from object store")
+            object_store = ObjectStore(os_url, cache_folder=os_cache_folder)
+    return object_store
+
+
+def get_cif_content_from_os(filename):
+    """Load CIF content via GET request from object store."""
+    return get_object_store().get(filename)
+
+
+def prefetch_cifs_from_os(filenames):
+    """Fetch CIF files from object store concurrently in the background."""
+    get_object_store().prefetch(filenames)
+
+
+mapped_rdf_store = FileCache(lambda: load_columns(rdf_store),
+                             [store_index(rdf_store)])
+
+
+def get_rdf_dataframe_from_disk(name):
+    """Return RDF of a structure.
+
+    Uses the memory-mapped RDFs created by pack_rdfs, if present and
+    containing the structure, and falls back to parsing the CSV file of the
+    structure otherwise.
+    """
+    if not os.path.exists(store_index(rdf_store)):
+        return parse_rdf_csv(name)
+
+    columns, _masks, index = mapped_rdf_store.get()
+    if name not in index['rows']:
+        # added after the last import
+        return parse_rdf_csv(name)
+    start, stop = index['rows'][name]
+    return pd.DataFrame(
+        collections.OrderedDict((label, values[start:stop])
+                                for label, values in columns.items()))
+
+
+def load_results_by_name():
+    """Load results with and without tail-corrections, grouped by name.
+
+    Returns a (results by name, empty results) tuple for each of the two.
+    """
+    results = []
+    for df in get_results_dataframes_from_disk():
+        by_name = {name: group for name, group in df.groupby('name')}
+        results.append((by_name, df.iloc[:0]))
+    return tuple(results)
+
+
+results_store = FileCache(load_results_by_name,
+                          [tailcorrection_csv, no_tailcorrection_csv])
+
+
+mapped_results_store = FileCache(
+    lambda: [load_columns(folder) for folder in results_stores],
+    [store_index(folder) for folder in results_stores])
+
+
+def get_results_dataframe_from_store(store, name):
+    """Return results of one structure from columns loaded by load_columns."""
+    columns, masks, index = store
+    start, stop = index['rows'].get(name, (0, 0))
+    df = pd.DataFrame(
+        collections.OrderedDict((label, np.array(values[start:stop]))
+                                for label, values in columns.items()))
+    for label, mask in masks.items():
+        df[label] = df[label].astype(object)
+        df.loc[mask[start:stop], label] = np.nan
+    return df
+
+
+def get_results_dataframes(name):
+    """Return results with and without tail-corrections for one structure.
+
+    Uses the memory-mapped results created by pack_results, if present.
+    Otherwise, both CSV files are parsed once per process and only parsed
+    again when one of them changes.
+    """
+    if all(os.path.exists(store_index(folder)) for folder in results_stores):
+        return tuple(
+            get_results_dataframe_from_store(store, name)
+            for store in mapped_results_store.get())
+
+    return tuple(
+        by_name.get(name, empty) for by_name, empty in results_store.get())
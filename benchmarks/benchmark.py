@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark import and query hot paths on synthetic data.
+
+Creates a data folder with synthetic properties, results, RDFs and
+structures of configurable size, imports it with import_db.py and times the
+queries of the figure and detail apps. Timings are written as JSON, e.g.
+
+    python benchmarks/benchmark.py --size 100000 --output results.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+figure_dir = os.path.join(root_dir, 'figure')
+
+# columns of the results files that are plotted by the detail app
+result_columns = [
+    'henry_coefficient_widom_average',
+    'henry_coefficient_widom_dev',
+    'loading_absolute_average_low_p',
+    'loading_absolute_dev_low_p',
+    'loading_absolute_average_medium_p',
+    'loading_absolute_dev_medium_p',
+    'loading_absolute_average_high_p',
+    'loading_absolute_dev_high_p',
+]
+cutoffs = np.arange(10., 30., 2.)
+rdf_points = 500
+
+cif_template = """# synthetic structure
+data_{name}
+_symmetry_space_group_name_H-M   'P 1'
+_cell_length_a   10.00000000
+_cell_length_b   10.00000000
+_cell_length_c   10.00000000
+_cell_angle_alpha   90.00000000
+_cell_angle_beta   90.00000000
+_cell_angle_gamma   90.00000000
+_symmetry_Int_Tables_number   1
+loop_
+ _atom_site_type_symbol
+ _atom_site_label
+ _atom_site_fract_x
+ _atom_site_fract_y
+ _atom_site_fract_z
+{atoms}
+"""
+
+
+def get_names(size):
+    return np.array(['bench{:07d}'.format(i) for i in range(size)])
+
+
+def create_properties(path, size, rng):
+    """Write properties of size structures, following columns.yml."""
+    with open(os.path.join(figure_dir, 'static', 'columns.yml'), 'r') as f:
+        columns = yaml.safe_load(f)
+
+    data = pd.DataFrame({'name': get_names(size)})
+    for q in columns:
+        if q['type'] == 'float':
+            low, high = q['range']
+            data[q['column']] = rng.uniform(low, high, size)
+        else:
+            data[q['column']] = rng.choice(q['values'], size)
+    data.to_csv(path, index=False)
+
+
+def create_results(path, names, rng):
+    """Write results for each cutoff of the given structures."""
+    data = pd.DataFrame({
+        'name': np.repeat(names, len(cutoffs)),
+        'cutoff': np.tile(cutoffs, len(names)),
+    })
+    for column in result_columns:
+        data[column] = rng.uniform(0, 10, len(data))
+    data.to_csv(path)
+
+
+def create_rdfs(folder, names, rng):
+    os.makedirs(folder)
+    distance = np.arange(rdf_points) * 0.04 + 0.02
+    for name in names:
+        histogram = rng.uniform(0, 2, rdf_points)
+        with open(os.path.join(folder, name + '.csv'), 'w') as f:
+            f.write('# column 1: index\n'
+                    '# column 2: distance [A]\n'
+                    '# column 3: RDF histogram\n'
+                    '# column 4: unnormalized distance histogram\n')
+            for i in range(rdf_points):
+                f.write('{} {:f} {:f} {:f}\n'.format(i, distance[i],
+                                                     histogram[i],
+                                                     histogram[i] * 100))
+
+
+def create_structures(folder, names, rng, natoms=100):
+    os.makedirs(folder)
+    for name in names:
+        atoms = '\n'.join(
+            '  C  C{}  {:.6f}  {:.6f}  {:.6f}'.format(i, *rng.uniform(0, 1, 3))
+            for i in range(natoms))
+        with open(os.path.join(folder, name + '.cif'), 'w') as f:
+            f.write(cif_template.format(name=name, atoms=atoms))
+
+
+def create_data(data_folder, size, detail_size, seed=0):
+    """Create synthetic input files of import_db.py in data_folder.
+
+    Results, RDFs and structures are only created for the first detail_size
+    structures, which are looked up by the detail benchmarks.
+    """
+    rng = np.random.RandomState(seed)
+    names = get_names(detail_size)
+
+    os.makedirs(data_folder)
+    create_properties(os.path.join(data_folder, 'properties.csv'), size, rng)
+    create_results(os.path.join(data_folder, 'tailcorrection_data.csv'), names,
+                   rng)
+    create_results(os.path.join(data_folder, 'no_tailcorrection_data.csv'),
+                   names, rng)
+    create_rdfs(os.path.join(data_folder, 'rdfs'), names, rng)
+    create_structures(os.path.join(data_folder, 'structures'), names, rng)
+
+
+def timeit(function, repeat, args_list=None):
+    """Time function calls.
+
+    The first call is reported separately, since it fills process-wide
+    caches (engine, table model, data stores).
+    """
+    if args_list is None:
+        args_list = [()] * repeat
+    times = []
+    for args in args_list[:repeat]:
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return dict(first=times[0],
+                min=min(times),
+                median=float(np.median(times)),
+                mean=float(np.mean(times)),
+                repeat=len(times))
+
+
+def get_query_scenarios():
+    """Return filter states of the figure app to benchmark."""
+    from config import presets
+
+    scenarios = dict(
+        unfiltered={},
+        default_preset=presets['default'],
+        density_and_groups={
+            'density': [0.5, 1.5],
+            'group': ['MOFs', 'COFs'],
+        },
+    )
+    return scenarios
+
+
+def run_benchmarks(workdir, args):
+    """Import the data in workdir and time the queries of the apps."""
+    results = {}
+
+    start = time.time()
+    command = [sys.executable, os.path.join(root_dir, 'import_db.py')]
+    if args.chunksize:
+        command += ['--chunksize', str(args.chunksize)]
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, cwd=workdir, stdout=devnull)
+    results['import_db'] = dict(total=time.time() - start)
+
+    # import_db expects the data folder in the working directory
+    os.chdir(workdir)
+    sys.path[:0] = [root_dir, figure_dir]
+    import app_data
+    import import_db
+    from config import quantities
+    from figure.query import (cached, get_active_filters, get_data_memory,
+                              get_data_sqla)
+    from figure.server_lifecycle import get_preset_filters
+    from detail.query import get_sqlite_data
+
+    projections = ['pca_1', 'pca_2', 'group', 'sampled', 'name', 'filename']
+    for label, preset in get_query_scenarios().items():
+        filters = get_active_filters(get_preset_filters(preset), quantities)
+        for get_data in [get_data_sqla, get_data_memory]:
+            results['{}.{}'.format(get_data.__name__, label)] = timeit(
+                lambda filters=filters, get_data=get_data: get_data(
+                    projections, filters), args.repeat)
+        # the first call fills the query cache, later calls are served by it
+        get_data = cached(get_data_sqla)
+        results['get_data_cached.' + label] = timeit(
+            lambda filters=filters, get_data=get_data: get_data(
+                projections, filters), args.repeat)
+
+    rng = np.random.RandomState(1)
+    names = [(name,) for name in rng.choice(get_names(args.detail_size),
+                                            args.repeat)]
+    results['get_sqlite_data'] = timeit(get_sqlite_data, args.repeat, names)
+    results['get_results_dataframes_from_disk'] = timeit(
+        import_db.get_results_dataframes_from_disk, args.repeat)
+    results['get_results_dataframes'] = timeit(app_data.get_results_dataframes,
+                                               args.repeat, names)
+    results['get_rdf_dataframe_from_disk'] = timeit(
+        app_data.get_rdf_dataframe_from_disk, args.repeat, names)
+
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size',
+                        type=int,
+                        default=10000,
+                        help="number of structures")
+    parser.add_argument('--detail-size',
+                        type=int,
+                        default=1000,
+                        help="number of structures with results, RDFs and "
+                        "structure files")
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=20,
+                        help="number of calls per benchmark")
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=None,
+                        help="import CSV file in chunks of this many rows")
+    parser.add_argument('--workdir',
+                        default=None,
+                        help="folder for the synthetic data (default: "
+                        "temporary folder, removed afterwards)")
+    parser.add_argument('--output',
+                        default=None,
+                        help="JSON file for the results (default: stdout)")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    args.detail_size = min(args.detail_size, args.size)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    data_folder = os.path.join(workdir, 'data')
+    try:
+        if not os.path.exists(data_folder):
+            print("Creating synthetic data in {}".format(data_folder),
+                  file=sys.stderr)
+            create_data(data_folder, args.size, args.detail_size)
+        results = run_benchmarks(workdir, args)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = dict(
+        size=args.size,
+        detail_size=args.detail_size,
+        chunksize=args.chunksize,
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        results=results,
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
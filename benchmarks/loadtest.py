@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Load test the bokeh apps with concurrent simulated visitors.
+
+Each visitor opens a session of the figure app through bokeh.client, clicks
+Plot with random filter settings a few times, and then visits the detail page
+of a random structure. Reports latencies of session creation and updates as
+well as the memory and CPU usage of the server processes as JSON, e.g.
+
+    python benchmarks/loadtest.py --start --num-procs 4 --visitors 20
+
+starts `serve.py figure detail` with 4 worker processes in the current
+directory (containing the data folder) and runs 20 visitors concurrently.
+To test a running server, pass --url and --server-pid.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_stat(pid):
+    """Return fields of /proc/<pid>/stat after the command (Linux only)."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # skip command, which may contain spaces
+        return f.read().rsplit(')', 1)[1].split()
+
+
+def get_process_tree(pid):
+    """Return pid and the pids of all its descendants (Linux only)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            # the parent pid is field 4 of the stat file
+            ppid = int(read_stat(entry)[1])
+        except (IOError, OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for parent in pids:
+        pids += children.get(parent, [])
+    return pids
+
+
+class ProcessMonitor(threading.Thread):
+    """Sample memory and CPU usage of a process and its descendants.
+
+    With several worker processes, the usage of all workers is summed. Linux
+    only.
+    """
+
+    def __init__(self, pid, interval=0.5):
+        super(ProcessMonitor, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.rss = []  # bytes
+        self.cpu = []  # percent of one core
+        self.processes = []  # number of processes
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def read_rss(pid):
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    @staticmethod
+    def read_cpu_time(pid):
+        fields = read_stat(pid)
+        # utime and stime are fields 14 and 15 of the stat file
+        return (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+
+    def read_tree(self):
+        """Return {pid: (rss, cpu time)} of the processes of the tree."""
+        usage = {}
+        for pid in get_process_tree(self.pid):
+            try:
+                usage[pid] = (self.read_rss(pid), self.read_cpu_time(pid))
+            except (IOError, OSError):
+                pass  # process has exited in the meantime
+        return usage
+
+    def run(self):
+        last_usage, last_time = self.read_tree(), time.time()
+        while not self._stop_event.wait(self.interval):
+            usage, now = self.read_tree(), time.time()
+            if self.pid not in usage:
+                break
+            self.rss.append(sum(rss for rss, _ in usage.values()))
+            # CPU time of processes that were already running at the last
+            # sample is counted since then, of new processes in full
+            cpu = sum(cpu - last_usage.get(pid, (0, 0.))[1]
+                      for pid, (_, cpu) in usage.items())
+            self.cpu.append(100 * cpu / (now - last_time))
+            self.processes.append(len(usage))
+            last_usage, last_time = usage, now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def report(self):
+        if not self.rss:
+            return {}
+        return dict(rss_max_mb=max(self.rss) / 1024.**2,
+                    rss_final_mb=self.rss[-1] / 1024.**2,
+                    cpu_mean_percent=float(np.mean(self.cpu)),
+                    cpu_max_percent=max(self.cpu),
+                    processes=max(self.processes))
+
+
+def click(session, button):
+    """Send click event of a button, like the browser does.
+
+    Does not wait for the reply, since the bokeh client drops changes of the
+    document that arrive while waiting for a reply; use wait_for instead.
+    """
+    from bokeh.protocol.messages.event import event_1
+
+    message = event_1(
+        event_1.create_header(), {},
+        json.dumps({
+            'event_name': 'button_click',
+            'event_values': {
+                'model_id': button.id
+            }
+        }))
+    # pylint: disable=protected-access
+    session._connection.send_message(message)
+
+
+def wait_for(session, condition, timeout):
+    """Apply changes from the server until condition() is true."""
+    # pylint: disable=protected-access
+    connection = session._connection
+    loop = connection._loop
+    timeout_handle = loop.call_later(timeout, loop.stop)
+    connection._loop_until(condition)
+    loop.remove_timeout(timeout_handle)
+    if not condition():
+        raise RuntimeError("Timeout waiting for server")
+
+
+def ignore_patch_errors(session):
+    """Skip changes from the server that the bokeh client cannot apply.
+
+    The client fails to deserialize some columns sent as binary buffers
+    (only needed for rendering in the browser).
+    """
+    from bokeh.core.property.bases import DeserializationError
+
+    # pylint: disable=protected-access
+    handle_patch = session._handle_patch
+
+    def _handle_patch(message):
+        try:
+            handle_patch(message)
+        except DeserializationError:
+            pass
+
+    session._handle_patch = _handle_patch
+
+
+def randomize_filters(document, rng):
+    """Set sliders and checkboxes of the figure app to random values."""
+    from bokeh.models.widgets import RangeSlider, CheckboxButtonGroup
+
+    for slider in document.select({'type': RangeSlider}):
+        slider.value = tuple(
+            sorted(rng.uniform(slider.start, slider.end, 2).tolist()))
+    for group in document.select({'type': CheckboxButtonGroup}):
+        active = [i for i in range(len(group.labels)) if rng.rand() < 0.7]
+        group.active = active or [rng.randint(len(group.labels))]
+
+
+class Visitor(threading.Thread):
+    """Simulated visitor of the figure and detail apps."""
+
+    def __init__(self, seed, args, names, timings):
+        super(Visitor, self).__init__()
+        self.daemon = True
+        self.args = args
+        self.names = names
+        self.timings = timings
+        self.rng = np.random.RandomState(seed)
+        self.errors = []
+
+    def record(self, label, start):
+        self.timings.setdefault(label, []).append(time.time() - start)
+
+    def visit_figure(self):
+        from bokeh.client import pull_session
+        from bokeh.models.widgets import Button
+
+        start = time.time()
+        session = pull_session(url=self.args.url + '/figure')
+        self.record('figure_session', start)
+        ignore_patch_errors(session)
+        try:
+            document = session.document
+            button = [
+                b for b in document.select({'type': Button})
+                if b.label == 'Plot'
+            ][0]
+            for _ in range(self.args.clicks):
+                randomize_filters(document, self.rng)
+                button.button_type = 'primary'
+                start = time.time()
+                click(session, button)
+                wait_for(session, lambda: button.button_type == 'success',
+                         self.args.timeout)
+                self.record('update', start)
+        finally:
+            session.close()
+
+    def visit_detail(self):
+        from bokeh.client import pull_session
+        import jsmol_bokeh_extension  # pylint: disable=unused-variable
+
+        name = self.names[self.rng.randint(len(self.names))]
+        start = time.time()
+        session = pull_session(url=self.args.url + '/detail',
+                               arguments={'name': name})
+        self.record('detail_session', start)
+        ignore_patch_errors(session)
+        try:
+            # data of the structure is loaded after the session is created
+            wait_for(
+                session, lambda: session.document.select_one(
+                    {'name': 'loading'}) is None, self.args.timeout)
+            self.record('detail_loaded', start)
+        finally:
+            session.close()
+
+    def run(self):
+        try:
+            # each thread needs its own event loop for the bokeh client
+            import asyncio
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        except ImportError:
+            pass
+
+        for _ in range(self.args.visits):
+            try:
+                self.visit_figure()
+                self.visit_detail()
+            except Exception as exc:  # pylint: disable=broad-except
+                self.errors.append(repr(exc))
+
+
+def get_names():
+    """Return names of structures with detail pages (with results)."""
+    sys.path.insert(0, root_dir)
+    import import_db
+
+    df, _ = import_db.get_results_dataframes_from_disk()
+    return sorted(set(df['name'].astype(str)))
+
+
+def start_server(args):
+    command = [
+        sys.executable,
+        os.path.join(root_dir, 'serve.py'),
+        os.path.join(root_dir, 'figure'),
+        os.path.join(root_dir, 'detail'), '--port',
+        str(args.port), '--num-procs',
+        str(args.num_procs)
+    ]
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+
+    start = time.time()
+    while time.time() - start < args.timeout:
+        try:
+            socket.create_connection(('localhost', args.port), 1).close()
+            return server
+        except (IOError, OSError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def summarize(times):
+    times = np.array(times)
+    return dict(count=len(times),
+                mean=float(times.mean()),
+                p50=float(np.percentile(times, 50)),
+                p90=float(np.percentile(times, 90)),
+                p99=float(np.percentile(times, 99)),
+                max=float(times.max()))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--visitors',
+                        type=int,
+                        default=10,
+                        help="number of concurrent visitors")
+    parser.add_argument('--visits',
+                        type=int,
+                        default=3,
+                        help="figure and detail visits per visitor")
+    parser.add_argument('--clicks',
+                        type=int,
+                        default=3,
+                        help="Plot clicks per figure visit")
+    parser.add_argument('--url',
+                        default=None,
+                        help="URL of the server "
+                        "(default: http://localhost:<port>)")
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--start',
+                        action='store_true',
+                        help="start serve.py in the current directory")
+    parser.add_argument('--num-procs',
+                        type=int,
+                        default=1,
+                        help="worker processes of the started server "
+                        "(0: one per core)")
+    parser.add_argument('--server-pid',
+                        type=int,
+                        default=None,
+                        help="process to monitor (default: started server)")
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=60,
+                        help="seconds to wait for the server")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output',
+                        default=None,
+                        help="JSON file for the results (default: stdout)")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.url is None:
+        args.url = 'http://localhost:{}'.format(args.port)
+    names = get_names()
+
+    server = start_server(args) if args.start else None
+    pid = args.server_pid or (server.pid if server else None)
+    monitor = ProcessMonitor(pid) if pid else None
+    try:
+        if monitor:
+            monitor.start()
+        timings = {}
+        visitors = [
+            Visitor(args.seed + i, args, names, timings)
+            for i in range(args.visitors)
+        ]
+        start = time.time()
+        for visitor in visitors:
+            visitor.start()
+        for visitor in visitors:
+            visitor.join()
+        duration = time.time() - start
+        if monitor:
+            monitor.stop()
+    finally:
+        if server:
+            # workers do not exit with the parent process
+            for pid in reversed(get_process_tree(server.pid)):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            server.wait()
+
+    report = dict(
+        visitors=args.visitors,
+        visits=args.visits,
+        clicks=args.clicks,
+        duration=duration,
+        latency={k: summarize(v) for k, v in timings.items()},
+        server=monitor.report() if monitor else {},
+        errors=sum([v.errors for v in visitors], []),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,23 +5,32 @@ from os.path import dirname, join
 from copy import copy
 from collections import OrderedDict
 import json
+import logging
 
 from bokeh.layouts import layout, widgetbox
 import bokeh.models as bmd
 from bokeh.models.widgets import PreText, Button, Div
 from bokeh.io import curdoc
 from jsmol_bokeh_extension import JSMol
-from import_db import get_cif_content_from_disk as get_cif_str
-from import_db import get_rdf_dataframe_from_disk as get_rdf_df
-from import_db import get_results_dataframes_from_disk as get_results_df
-
-# from import_db import get_cif_content_from_os as get_cif_str
-from detail.query import get_sqlite_data as get_data
+from import_db import os_url, structure_extension, structure_url
+from app_data import get_rdf_dataframe_from_disk as get_rdf_df
+from app_data import get_results_dataframes as get_results_df
+from app_data import get_units, get_text_file, run_in_executor
+from metrics import timed
+
+if os_url:
+    from app_data import get_cif_content_from_os as get_cif_str
+else:
+    from app_data import get_cif_content_from_disk as get_cif_str
+from detail.query import get_sqlite_data as get_data, close_session
 
-html = bmd.Div(text=open(join(dirname(__file__), "description.html")).read(),
+html = bmd.Div(text=get_text_file(join(dirname(__file__),
+                                       "description.html")),
                width=800)
 
-download_js = open(join(dirname(__file__), "static", "download.js")).read()
+download_js = get_text_file(join(dirname(__file__), "static", "download.js"))
+download_url_js = get_text_file(
+    join(dirname(__file__), "static", "download_url.js"))
 
 plot_info = Div(text="Pore blocking is not relevant for this structure.",
                 width=300,
@@ -160,6 +169,11 @@ used_block = list(set(blocked_pockets) - set(non_permeable))
 
 allowed_names = mofs + famous_mofs + cofs + zeolites
 
+if os_url:
+    from app_data import prefetch_cifs_from_os
+    prefetch_cifs_from_os(
+        ["{}.{}".format(n, structure_extension) for n in allowed_names])
+
 
 def get_name_from_url():
     args = curdoc().session_context.request.arguments
@@ -201,23 +215,21 @@ def errorbar(fig,
     fig.multi_line(y_err_x, y_err_y, color=color, **error_kwargs)
 
 
-def table_widget(entry):
+@timed("table_widget")
+def table_widget(entry, units):
     from bokeh.models import ColumnDataSource
     from bokeh.models.widgets import DataTable, TableColumn
 
     entry_dict = copy(entry.__dict__)
-    print(entry_dict.keys())
     # Note: iterate over old dict, not the copy that is changing
     for k, v in entry.__dict__.items():
         if k == "id" or k == "_sa_instance_state":
             del entry_dict[k]
 
-        # use _units keys to rename corresponding quantity
-        if k[-6:] == "_units":
-            prop = k[:-6]
-            new_key = "{} [{}]".format(prop, entry_dict[k])
-            del entry_dict[k]
-            entry_dict[new_key] = entry_dict.pop(prop)
+        # add units to the name of the corresponding quantity
+        elif k in units:
+            new_key = "{} [{}]".format(k, units[k])
+            entry_dict[new_key] = entry_dict.pop(k)
 
     # order entry dict
     entry_dict = OrderedDict([(k, entry_dict[k])
@@ -251,11 +263,10 @@ def table_widget(entry):
     return widgetbox(data_table)
 
 
-def rdf_plot(name):
+def rdf_plot(df_rdf):
     from bokeh.plotting import figure
 
-    if name != "PAU":
-        df_rdf = get_rdf_df(name)
+    if df_rdf is not None:
         p = figure(
             width=800,
             height=int(800 / 1.61803),
@@ -273,17 +284,13 @@ def rdf_plot(name):
     return p
 
 
-def get_grids(name, df_tailcorrection, df_no_tailcorrection):
+def get_grids(data_tail_correction, data_no_tail_correction):
     from bokeh.plotting import figure
     from bokeh.layouts import gridplot
 
     golden_ratio = 1.61803
     golden_ratio_reci = 1 / golden_ratio
 
-    data_no_tail_correction = df_no_tailcorrection[df_no_tailcorrection["name"]
-                                                   == name]
-    data_tail_correction = df_tailcorrection[df_tailcorrection["name"] == name]
-
     plot_width = 400
     plot_height = int(plot_width * golden_ratio_reci)
 
@@ -479,90 +486,141 @@ def get_grids(name, df_tailcorrection, df_no_tailcorrection):
     return grid
 
 
-# Maybe add here a plot with the CH4-Framework RDF
-
-sizing_mode = "fixed"
-cof_name = get_name_from_url()
-entry = get_data(cof_name, plot_info)
-
-if cof_name in allowed_names:
-    cif_str = get_cif_str(entry.filename)
-    info = dict(
-        height="100%",
-        width="100%",
-        use="HTML5",
-        # serverURL="https://chemapps.stolaf.edu/jmol/jsmol/php/jsmol.php",
-        # j2sPath="https://chemapps.stolaf.edu/jmol/jsmol/j2s",
-        # serverURL="https://www.materialscloud.org/discover/scripts/external/jsmol/php/jsmol.php",
-        # j2sPath="https://www.materialscloud.org/discover/scripts/external/jsmol/j2s",
-        serverURL="detail/static/jsmol/php/jsmol.php",
-        j2sPath="detail/static/jsmol/j2s",
-        script="""set antialiasDisplay ON;
+def load_data(name, session_id):
+    """Load data shown for a structure.
+
+    Runs in the I/O thread pool (see app_data.run_in_executor), so it must
+    not modify models that are part of the document.
+    """
+    with timed("load_entry"):
+        data = dict(entry=get_data(name, session_id=session_id),
+                    units=get_units())
+    if data["entry"] is None:
+        return data
+    if name in allowed_names:
+        if not structure_url:
+            with timed("load_cif"):
+                data["cif_str"] = get_cif_str(data["entry"].filename)
+        with timed("load_results"):
+            data["results"] = get_results_df(name)
+        with timed("load_rdf"):
+            data["rdf"] = get_rdf_df(name) if name != "PAU" else None
+    return data
+
+
+def show_data(future):
+    """Replace the loading message by the layout of the structure."""
+    try:
+        data = future.result()
+    except Exception as exc:  # pylint: disable=broad-except
+        logging.exception("Loading data of %s failed", cof_name)
+        tab.child = Div(text="Error loading {}: {}".format(cof_name, exc),
+                        width=800)
+        return
+    entry = data["entry"]
+
+    if entry is None:
+        tab.child = Div(text="No matching structure found.", width=800)
+    elif cof_name in allowed_names:
+        if structure_url:
+            # structure is served separately and fetched on demand (see serve.py)
+            cif_url = structure_url.format(entry.filename)
+            script = """set antialiasDisplay ON;
+load "{}"
+""".format(cif_url)
+            btn_download_cif.callback = bmd.CustomJS(args=dict(
+                url=cif_url, filename=entry.filename),
+                                                     code=download_url_js)
+        else:
+            cif_str = data["cif_str"]
+            script = """set antialiasDisplay ON;
 load data "cifstring"
 {}
 end "cifstring"
 """.format(cif_str)
-        ## Note: Need PHP server for approach below to work
-        #    script="""set antialiasDisplay ON;
-        # load cif::{};
-        # """.format(get_cif_url(entry.filename))
-    )
+            btn_download_cif.callback = bmd.CustomJS(args=dict(
+                string=cif_str, filename=entry.filename),
+                                                     code=download_js)
+
+        info = dict(
+            height="100%",
+            width="100%",
+            use="HTML5",
+            # serverURL="https://chemapps.stolaf.edu/jmol/jsmol/php/jsmol.php",
+            # j2sPath="https://chemapps.stolaf.edu/jmol/jsmol/j2s",
+            # serverURL="https://www.materialscloud.org/discover/scripts/external/jsmol/php/jsmol.php",
+            # j2sPath="https://www.materialscloud.org/discover/scripts/external/jsmol/j2s",
+            serverURL="detail/static/jsmol/php/jsmol.php",
+            j2sPath="detail/static/jsmol/j2s",
+            script=script,
+            ## Note: Need PHP server for approach below to work
+            #    script="""set antialiasDisplay ON;
+            # load cif::{};
+            # """.format(get_cif_url(entry.filename))
+        )
 
-    btn_download_cif.callback = bmd.CustomJS(args=dict(
-        string=cif_str, filename=entry.filename),
-                                             code=download_js)
-    script_source = bmd.ColumnDataSource()
-
-    applet = JSMol(
-        width=600,
-        height=600,
-        script_source=script_source,
-        info=info,
-        js_url="detail/static/jsmol/JSmol.min.js",
-    )
+        script_source = bmd.ColumnDataSource()
+
+        applet = JSMol(
+            width=600,
+            height=600,
+            script_source=script_source,
+            info=info,
+            js_url="detail/static/jsmol/JSmol.min.js",
+        )
+
+        data_tail_correction, data_no_tail_correction = data["results"]
+
+        if cof_name in used_block:
+            plot_info_ = plot_info_blocked_pockets
+        elif cof_name in non_permeable:
+            plot_info_ = plot_info_non_permeable
+        else:
+            plot_info_ = plot_info
+
+        if cof_name in cofs:
+            citation = citation_cof
+        elif cof_name in zeolites:
+            citation = citation_zeolite
+        elif cof_name in mofs:
+            citation = citation_mof
+        else:
+            citation = citation_else
+
+        l = layout(
+            [[
+                [[applet], [citation]],
+                [[table_widget(entry, data["units"])], [btn_download_table]],
+            ],
+             [
+                 get_grids(
+                     data_tail_correction=data_tail_correction,
+                     data_no_tail_correction=data_no_tail_correction,
+                 )
+             ], [rdf_plot(data["rdf"])], [plot_info_]],
+            sizing_mode=sizing_mode,
+        )
 
-    df_tailcorrection, df_no_tailcorrection = get_results_df()
+        tab.child = l
 
-    if cof_name in used_block:
-        plot_info_ = plot_info_blocked_pockets
-    elif cof_name in non_permeable:
-        plot_info_ = plot_info_non_permeable
-    else:
-        plot_info_ = plot_info
-
-    if cof_name in cofs:
-        citation = citation_cof
-    elif cof_name in zeolites:
-        citation = citation_zeolite
-    elif cof_name in mofs:
-        citation = citation_mof
     else:
-        citation = citation_else
-
-    l = layout(
-        [[
-            [[applet], [citation]],
-            [[table_widget(entry)], [btn_download_table]],
-        ],
-         [
-             get_grids(
-                 cof_name,
-                 df_tailcorrection=df_tailcorrection,
-                 df_no_tailcorrection=df_no_tailcorrection,
-             )
-         ], [rdf_plot(cof_name)], [plot_info_]],
-        sizing_mode=sizing_mode,
-    )
+        tab.child = layout(
+            [[[[table_widget(entry, data["units"])], [btn_download_table]]],
+             [plot_info_not_sampled]],
+            sizing_mode=sizing_mode,
+        )
 
-else:
-    l = layout(
-        [[[[table_widget(entry)], [btn_download_table]]],
-         [plot_info_not_sampled]],
-        sizing_mode=sizing_mode,
-    )
 
-# We add this as a tab
-tab = bmd.Panel(child=l, title=cof_name)
+# Maybe add here a plot with the CH4-Framework RDF
+
+sizing_mode = "fixed"
+cof_name = get_name_from_url()
+curdoc().on_session_destroyed(close_session)
+
+# We add this as a tab (showing the structure once show_data is called)
+tab = bmd.Panel(child=Div(text="Loading {}...".format(cof_name),
+                          name="loading"),
+                title=cof_name)
 tabs = bmd.widgets.Tabs(tabs=[tab])
 
 # Put the tabs in the current document for display
@@ -570,3 +628,6 @@ curdoc().title = (
     "Applicability of tail-corrections in the molecular simulations of porous materials"
 )
 curdoc().add_root(layout([html, tabs]))
+
+run_in_executor(curdoc(), show_data, load_data, cof_name,
+                curdoc().session_context.id)
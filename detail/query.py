@@ -1,22 +1,70 @@
 """ Queries to the DB
 """
+from bokeh.io import curdoc
 
+Session = None  # session factory
+sessions = {}  # ORM sessions by bokeh session id
 
-def get_sqlite_data(name, plot_info):
-    """Query the sqlite database"""
-    from import_db import automap_table, engine
+
+def get_session(session_id=None):
+    """Return ORM session of a bokeh session.
+
+    Sessions are created on first use and closed by close_session when the
+    bokeh session is destroyed. Connections are taken from the pool of the
+    read-only engine, see app_data.get_engine.
+
+    Pass the id of the bokeh session when querying from another thread,
+    where curdoc() does not refer to the document of the session.
+    """
+    global Session  # pylint: disable=global-statement
+    from app_data import get_engine
     from sqlalchemy.orm import sessionmaker
 
-    # configure Session class with desired options
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    if Session is None:
+        # keep loaded attributes accessible after the connection is released
+        Session = sessionmaker(expire_on_commit=False)
+
+    if session_id is None:
+        context = curdoc().session_context
+        session_id = context.id if context is not None else None
+    if session_id not in sessions:
+        sessions[session_id] = Session(bind=get_engine())
+    return sessions[session_id]
+
+
+def close_session(session_context):
+    """Close ORM session of a destroyed bokeh session.
+
+    Register with curdoc().on_session_destroyed.
+    """
+    session = sessions.pop(session_context.id, None)
+    if session is not None:
+        session.close()
+
+
+def get_sqlite_data(name, plot_info=None, session_id=None):
+    """Query the sqlite database
+
+    Returns None if there is no structure of that name. Omit plot_info when
+    querying from another thread, where models of the document must not be
+    modified.
+    """
+    from app_data import get_table
+    from import_db import internal_columns
+    from sqlalchemy.orm import load_only
 
-    Table = automap_table(engine)
+    Table = get_table()
+    columns = [
+        c.key for c in Table.__table__.columns if c.key not in internal_columns
+    ]
 
-    query = session.query(Table).filter_by(name=str(name))
+    session = get_session(session_id)
+    # name is unique, so a single lookup tells whether the structure exists
+    entry = session.query(Table).options(load_only(*columns)).filter_by(
+        name=str(name)).one_or_none()
+    # return connection to the pool
+    session.commit()
 
-    nresults = query.count()
-    if nresults == 0:
+    if entry is None and plot_info is not None:
         plot_info.text = "No matching structure found."
-        return None
-    return query.one()
+    return entry
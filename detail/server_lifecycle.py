@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Lifecycle hooks of the detail app.
+
+on_server_loaded runs once per server process, the session hooks count
+sessions for the metrics (see metrics.py). See
+https://bokeh.pydata.org/en/1.3.4/docs/user_guide/server.html#lifecycle-hooks
+"""
+from __future__ import print_function
+import logging
+import os
+import time
+from os.path import dirname, join
+
+import metrics
+
+
+def on_server_loaded(server_context):  # pylint: disable=unused-argument
+    """Warm up caches before the first session is created.
+
+    Reflects the structures table and loads units, results and RDFs as well
+    as the static files, such that the first visitor does not have to wait.
+    """
+    import app_data
+    import import_db
+
+    start = time.time()
+    for path in [
+            join(dirname(__file__), "description.html"),
+            join(dirname(__file__), "static", "download.js"),
+            join(dirname(__file__), "static", "download_url.js"),
+    ]:
+        app_data.get_text_file(path)
+
+    app_data.get_table()
+    app_data.get_units()
+    app_data.get_results_dataframes("")
+    if os.path.exists(import_db.store_index(import_db.rdf_store)):
+        app_data.mapped_rdf_store.get()
+
+    logging.info("Warmed up detail app in %.2fs", time.time() - start)
+
+
+def on_session_created(session_context):  # pylint: disable=unused-argument
+    metrics.session_created("detail")
+
+
+def on_session_destroyed(session_context):  # pylint: disable=unused-argument
+    metrics.session_destroyed("detail")
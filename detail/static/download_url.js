@@ -0,0 +1,17 @@
+fetch(url).then(function (response) {
+    return response.text();
+}).then(function (string) {
+    var blob = new Blob([string], { type: 'text/csv;charset=utf-8;' });
+
+    //addresses IE
+    if (navigator.msSaveBlob) {
+        navigator.msSaveBlob(blob, filename);
+    } else {
+        var link = document.createElement('a');
+        link.href = URL.createObjectURL(blob);
+        link.download = filename;
+        link.target = "_blank";
+        link.style.visibility = 'hidden';
+        link.dispatchEvent(new MouseEvent('click'));
+    }
+});
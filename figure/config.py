@@ -33,6 +33,29 @@ for k in presets.keys():
     if "clr" not in presets[k].keys():
         presets[k]["clr"] = presets["default"]["clr"]
 
+# Backend for queries of the figure app:
+#  * "sqlite": query the sqlite database on every update
+#  * "memory": query an in-memory copy of the database, shared by all sessions
+query_backend = "sqlite"
+
 max_points = 70000
 
+# Order in which matching rows are sampled when there are more than max_points.
+# Either a column name (e.g. the random "sample_key" added by import_db.py),
+# "random" for a fresh random sample per query or None for table order.
+sample_order = "sample_key"
+
+# Viewport mode: when results are truncated to max_points, zooming or panning
+# fetches the points within the visible range, once the range has not changed
+# for viewport_delay milliseconds.
+viewport_mode = True
+viewport_delay = 300
+
+# Results of recent queries are cached per server process, up to a total of
+# query_cache_max_bytes of arrays (0 disables cache). Entries expire after
+# query_cache_max_age seconds or when the data changes. Queries of a
+# viewport and queries with sample_order "random" are not cached.
+query_cache_max_bytes = 256 * 1024**2
+query_cache_max_age = 600
+
 unit_dict = {"loading": "molecules / UC"}
@@ -3,8 +3,12 @@
 from __future__ import print_function
 import collections
 from copy import copy
+import logging
 from os.path import join
+import time
 
+import numpy as np
+from bokeh.events import Reset
 from bokeh.plotting import figure
 from bokeh.layouts import layout, widgetbox
 import bokeh.models as bmd
@@ -20,13 +24,35 @@ from bokeh.io import curdoc
 
 import config
 from config import quantities, presets
-from figure.query import get_data_sqla as get_data
-from figure.query import data_empty
-
-html = bmd.Div(text=open(join(config.static_dir, "description.html")).read(),
+from figure.query import data_empty, get_active_filters
+from app_data import get_text_file, run_in_executor
+from metrics import observe_duration, timed
+
+if config.query_backend == "memory":
+    from figure.query import get_data_memory as get_data
+else:
+    from figure.query import get_data_sqla as get_data
+if config.query_cache_max_bytes:
+    from figure.query import cached
+    get_data = cached(get_data)
+
+html = bmd.Div(text=get_text_file(join(config.static_dir,
+                                       "description.html")),
                width=800)
 
-redraw_plot = True
+# the plot only needs to be redrawn when switching between numeric and group
+# coloring or when the axes change; otherwise, updating the data source is
+# sufficient
+redraw_plot = False
+color_mapper = None
+
+# state of the plotted data, see update and fetch_viewport
+plotted_projections = None
+plotted_filters = None  # filters of the plotted data, see get_active_filters
+overview_bounds = None  # (x_min, x_max, y_min, y_max) of truncated results
+viewport_shown = False
+viewport_callback = None  # pending fetch_viewport, see on_range_change
+data_request = 0  # number of the latest query, see fetch_data
 
 
 def get_preset_label_from_url():
@@ -169,14 +195,137 @@ hover = bmd.HoverTool(tooltips=[])
 tap = bmd.TapTool()
 
 
+def fetch_data(projections, filters, callback, viewport=None):
+    """Query data without blocking the server and pass it to callback.
+
+    The query runs in the I/O thread pool. It gets the values of the filters
+    (see get_active_filters) rather than the widgets, since models of the
+    document must not be accessed from other threads. Results of queries superseded by a later
+    call are dropped. If the query fails, the error is shown instead.
+    """
+    global data_request
+
+    data_request += 1
+    request = data_request
+    start = time.time()
+
+    def on_data(future):
+        if request != data_request:
+            return
+        try:
+            data, info = future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.exception("Query for %s failed", projections)
+            plot_info.text = "Error: {}".format(exc)
+            btn_plot.label = "Plot"
+            btn_plot.button_type = "danger"
+            return
+        # including the time waiting for a thread of the pool
+        observe_duration("fetch_data", time.time() - start)
+        plot_info.text = info
+        callback(data)
+
+    run_in_executor(curdoc(),
+                    on_data,
+                    get_data,
+                    projections,
+                    filters,
+                    viewport=viewport)
+
+
+def cancel_fetch_viewport():
+    global viewport_callback
+
+    if viewport_callback is not None:
+        curdoc().remove_timeout_callback(viewport_callback)
+        viewport_callback = None
+
+
+def on_range_change(attr, old, new):
+    """Schedule fetching points within the visible range of the plot.
+
+    Ranges change continuously while panning or zooming, so the fetch is
+    postponed until they have not changed for config.viewport_delay ms.
+    """
+    global viewport_callback
+
+    if overview_bounds is None:
+        return
+    cancel_fetch_viewport()
+    viewport_callback = curdoc().add_timeout_callback(fetch_viewport,
+                                                      config.viewport_delay)
+
+
+def fetch_viewport():
+    """Fetch points within the visible range of the plot.
+
+    Only needed if the plotted results were truncated to max_points; when
+    zoomed out to the full results, the overview is shown again.
+    """
+    global viewport_callback
+
+    viewport_callback = None
+    if overview_bounds is None:
+        return
+    p_cur = l.children[0].children[1]
+    viewport = ((p_cur.x_range.start, p_cur.x_range.end),
+                (p_cur.y_range.start, p_cur.y_range.end))
+    if None in viewport[0] or None in viewport[1]:
+        return
+
+    x_min, x_max, y_min, y_max = overview_bounds
+    shows_all = (viewport[0][0] <= x_min and viewport[0][1] >= x_max and
+                 viewport[1][0] <= y_min and viewport[1][1] >= y_max)
+    if shows_all and not viewport_shown:
+        return
+
+    def show_viewport(data):
+        global viewport_shown
+
+        source.data = data
+        viewport_shown = not shows_all
+        update_color_range()
+
+    # filters changed since the last Plot click only apply to the next one
+    fetch_data(plotted_projections,
+               plotted_filters,
+               show_viewport,
+               viewport=None if shows_all else viewport)
+
+
+def on_reset(event):  # pylint: disable=unused-argument
+    """Show the overview again when the plot is reset.
+
+    Resetting fits the ranges to the plotted data, which would keep showing
+    the points of the last viewport. The range changes of the reset arrive
+    before the event, so their pending fetch_viewport is cancelled.
+    """
+    if overview_bounds is None:
+        return
+    cancel_fetch_viewport()
+    if not viewport_shown:
+        return
+
+    def show_overview(data):
+        global viewport_shown
+
+        source.data = data
+        viewport_shown = False
+        update_color_range()
+
+    fetch_data(plotted_projections, plotted_filters, show_overview)
+
+
+@timed("create_plot")
 def create_plot():
     """Creates scatter plot.
 
     Note: While it is usually enough to update the data source, redrawing the
     plot is needed for bond_type coloring, when the colormap needs to change
-    and the colorbar is removed.
+    and the colorbar is removed, and for new axes, since zoomed ranges no
+    longer fit to the data.
     """
-    global source
+    global source, color_mapper
     p_new = figure(
         plot_height=600,
         plot_width=700,
@@ -189,6 +338,11 @@ def create_plot():
         title_location="right",
     )
     p_new.title.align = "center"
+    if config.viewport_mode:
+        for r in (p_new.x_range, p_new.y_range):
+            r.on_change("start", on_range_change)
+            r.on_change("end", on_range_change)
+        p_new.on_event(Reset, on_reset)
     p_new.title.text_font_size = "10pt"
     p_new.title.text_font_style = "italic"
 
@@ -216,6 +370,7 @@ def create_plot():
             # fill_alpha=0.6,
             legend="color",
         )
+        color_mapper = None
 
     else:
         cmap = bmd.LinearColorMapper(palette=Viridis256)
@@ -224,10 +379,25 @@ def create_plot():
         cbar = bmd.ColorBar(color_mapper=cmap, location=(0, 0))
         # cbar.color_mapper = bmd.LinearColorMapper(palette=Viridis256)
         p_new.add_layout(cbar, "right")
+        color_mapper = cmap
 
     return p_new
 
 
+def update_color_range():
+    """Adapt range of the color mapper to the plotted data.
+
+    The color bar does not show any ticks unless the range is set explicitly.
+    """
+    if color_mapper is None:
+        return
+
+    clrs = np.asarray(source.data["color"], dtype=float)
+    clrs = clrs[np.isfinite(clrs)]
+    if len(clrs):
+        color_mapper.update(low=clrs.min(), high=clrs.max())
+
+
 p = create_plot()
 
 # inp_preset
@@ -235,6 +405,7 @@ controls = ([inp_x, inp_y, inp_clr] + [_v for k, _v in filters_dict.items()] +
             [btn_plot, plot_info])
 
 
+@timed("update_legends")
 def update_legends(ly):
 
     q_x = quantities[inp_x.value]
@@ -276,7 +447,8 @@ def update_legends(ly):
     p.title.text = clr_label
 
     url = "detail?name=@name"
-    tap.callback = bmd.OpenURL(url=url)
+    if tap.callback is None:
+        tap.callback = bmd.OpenURL(url=url)
     # tap.callback = bmd.CustomJS.from_py_func(update_tap)
     # tap.callback = bmd.CustomJS(code="""console.info("hello TapTool")""")
 
@@ -299,7 +471,7 @@ def check_uniqueness(attr, old, new):
 
 
 def update():
-    global redraw_plot, source
+    global overview_bounds
 
     # update_legends(l)
 
@@ -312,17 +484,44 @@ def update():
         "filename",
     ]
 
-    source.data = get_data(projections, filters_dict, quantities, plot_info)
+    cancel_fetch_viewport()
+    # no viewport fetches for the old data while the query is running
+    overview_bounds = None
+    btn_plot.label = "Plotting..."
+    btn_plot.button_type = "warning"
+    filters = get_active_filters(filters_dict, quantities)
+    fetch_data(projections, filters,
+               lambda data: show_data(projections, filters, data))
+
+
+def show_data(projections, filters, data):
+    global redraw_plot, plotted_projections, plotted_filters, overview_bounds
+    global viewport_shown
+
+    # ranges fitted to the data stop fitting once the user zoomed or panned,
+    # so a new plot is needed to show other axes
+    axes_changed = (plotted_projections is not None and
+                    plotted_projections[:2] != projections[:2])
+    source.data = data
+    plotted_projections = projections
+    plotted_filters = filters
+    viewport_shown = False
+    if len(source.data["x"]) >= config.max_points:
+        overview_bounds = (np.nanmin(source.data["x"]),
+                           np.nanmax(source.data["x"]),
+                           np.nanmin(source.data["y"]),
+                           np.nanmax(source.data["y"]))
+    else:
+        overview_bounds = None
 
-    if redraw_plot:
-        figure = create_plot()
-        # TO DO: for some reason this destroys the coupling to source.data
-        # to figure out why (and then restrict this to actual redrawing scenarios)
-        l.children[0].children[1] = figure
-        redraw_plot = True
+    if redraw_plot or axes_changed:
+        l.children[0].children[1] = create_plot()
+        redraw_plot = False
 
+    update_color_range()
     update_legends(l)
     plot_info.text += " done!"
+    btn_plot.label = "Plot"
     btn_plot.button_type = "success"
     return
 
@@ -1,91 +1,353 @@
 """Querying the DB
 """
+import collections
+import functools
+import sys
+import threading
+import time
+
 from bokeh.models.widgets import RangeSlider, CheckboxButtonGroup
-from config import max_points
+from config import max_points, sample_order
+from config import query_cache_max_bytes, query_cache_max_age
+import numpy as np
 import pandas as pd
+from metrics import collectors, observe_size, timed
 
 # pylint: disable=too-many-locals
 data_empty = dict(x=[0], y=[0], uuid=["1234"], color=[0], name=["no data"])
 
 
-def get_data_sqla(projections, sliders_dict, quantities, plot_info):
+def get_active_filters(sliders_dict, quantities):
+    """Return filters that differ from their default.
+
+    Returns a list of (column, operator, values) tuples, where operator is
+    either "between" with values (min, max) of a RangeSlider, or "in" with
+    the values selected in a CheckboxButtonGroup.
+    """
+    filters = []
+    for k, v in sliders_dict.items():
+        if isinstance(v, RangeSlider):
+            if not v.value == quantities[k]["range"]:
+                filters.append((k, "between", (v.value[0], v.value[1])))
+        elif isinstance(v, CheckboxButtonGroup):
+            if not len(v.active) == len(v.labels):
+                filters.append((k, "in", [v.tags[i] for i in v.active]))
+    return filters
+
+
+def get_plot_info(nresults):
+    """Report number of matching and plotted frameworks."""
+    if not nresults:
+        return "No matching structure found."
+    return "{} frameworks found.\nPlotting {}...".format(
+        nresults, min(nresults, max_points)
+    )
+
+
+def get_sample_order(Table, projections):
+    """Return ORDER BY clauses used to sample results exceeding max_points.
+
+    If levels of detail are available for the plotted projection, points are
+    sampled coarsest level first, so that the sample covers all regions of the
+    plot (see import_db.get_lod_levels).
+    """
+    from import_db import get_lod_column
+    from sqlalchemy.sql import func
+
+    order = []
+    # databases created by older versions of import_db lack these columns
+    lod_column = get_lod_column(projections[0], projections[1])
+    if lod_column is not None and hasattr(Table, lod_column):
+        order.append(getattr(Table, lod_column))
+    if sample_order == "random":
+        order.append(func.random())
+    elif sample_order is not None and hasattr(Table, sample_order):
+        order.append(getattr(Table, sample_order))
+    return order
+
+
+@timed("get_data_sqla")
+def get_data_sqla(projections, filters, viewport=None):
     """Query database using SQLAlchemy.
 
+    filters is a list of (column, operator, values) tuples as returned by
+    get_active_filters. Returns the plot data and a text reporting the number
+    of results.
+
+    If viewport ((x_min, x_max), (y_min, y_max)) is given, only points within
+    the visible range of the plot are returned.
+
     Note: For efficiency, this uses the the sqlalchemy.sql interface which does
     not go via the (more convenient) ORM.
     """
-    from import_db import automap_table, engine
-    from sqlalchemy.sql import select, and_
+    from app_data import get_table, get_engine
+    from sqlalchemy.sql import select, and_, func
 
-    Table = automap_table(engine)
+    with timed("get_data_sqla.reflect"):
+        Table = get_table()
 
     selections = []
     for label in projections:
         selections.append(getattr(Table, label))
 
-    filters = []
-    for k, v in sliders_dict.items():
-        if isinstance(v, RangeSlider):
-            if not v.value == quantities[k]["range"]:
-                f = getattr(Table, k).between(v.value[0], v.value[1])
-                filters.append(f)
-        elif isinstance(v, CheckboxButtonGroup):
-            if not len(v.active) == len(v.labels):
-                f = getattr(Table, k).in_([v.tags[i] for i in v.active])
-                filters.append(f)
+    conditions = []
+    for column, operator, values in filters:
+        if operator == "between":
+            conditions.append(getattr(Table, column).between(*values))
+        else:
+            conditions.append(getattr(Table, column).in_(values))
+    if viewport is not None:
+        conditions.append(getattr(Table, projections[0]).between(*viewport[0]))
+        conditions.append(getattr(Table, projections[1]).between(*viewport[1]))
 
-    s = select(selections).where(and_(*filters))
+    s = select(selections).where(and_(*conditions))
+    order = get_sample_order(Table, projections)
+    if order:
+        s = s.order_by(*order)
 
-    results = engine.connect().execute(s).fetchall()
+    with get_engine().connect() as con:
+        # fetch one row more than needed to find out whether results are
+        # truncated
+        with timed("get_data_sqla.execute"):
+            cursor = con.execute(s.limit(max_points + 1))
+        with timed("get_data_sqla.fetch"):
+            rows = cursor.fetchall()
 
-    nresults = len(results)
-    if not results:
-        plot_info.text = "No matching structure found."
-        return data_empty
-    elif nresults > max_points:
-        results = results[:max_points]
-        plot_info.text = "{} frameworks found.\nPlotting {}...".format(
-            nresults, max_points
-        )
-    else:
-        plot_info.text = "{} frameworks found.\nPlotting {}...".format(
-            nresults, nresults
-        )
+        nresults = len(rows)
+        if nresults > max_points:
+            s_count = select([func.count()]).select_from(
+                Table.__table__).where(and_(*conditions))
+            with timed("get_data_sqla.count"):
+                nresults = con.execute(s_count).scalar()
+            rows = rows[:max_points]
 
-    # x,y position
-    x, y, clrs, sampled, names, filenames = zip(*results)
-    x = list(map(float, x))
-    y = list(map(float, y))
+    observe_size("get_data_sqla", len(rows))
+    if not nresults:
+        return data_empty, get_plot_info(nresults)
 
-    sampled_ = [20 if s == "sampled" else 10 for s in sampled]
-    lw = [2 if s == "sampled" else 0.1 for s in sampled]
+    with timed("get_data_sqla.convert"):
+        results = pd.DataFrame.from_records(rows, coerce_float=True)
+        # select by position, since projections may contain duplicate columns
+        columns = [results.iloc[:, i].values for i in range(len(projections))]
+        return get_plot_data(projections, *columns), get_plot_info(nresults)
 
-    if projections[2] == "group":
-        # clrs = map(lambda clr: bondtypes.index(clr), clrs)
-        clrs = list(clrs)
-        # df = pd.DataFrame({
-        #     'x': x,
-        #     'y': y,
-        #     'filename': filenames,
-        #     'name': names,
-        #     'color': clrs
-        # })
-        #
-        # my_own_order = ['COFs', 'MOFs', 'zeolites', 'sampled']
-        # my_own_order_dict = {key: i for i, key in enumerate(my_own_order)}
-        # inv_my_own_order_dict = {v: k for k, v in my_own_order_dict.items()}
-        # df['color_mapped'] = df['color'].map(my_own_order_dict)
-        # df.sort_values(by=['color_mapped'], inplace=True)
-        # x = df['x'].astype(float).to_list()
-        # y = df['y'].astype(float).to_list()
-        # filenames = df['filename'].to_list()
-        # clrs = df['color'].to_list()
-        # names = df['name'].to_list()
-    else:
-        clrs = list(map(float, clrs))
+
+def get_nbytes(data):
+    """Return memory used by the columns of plot data, in bytes."""
+    nbytes = 0
+    for values in data.values():
+        values = np.asarray(values)
+        nbytes += values.nbytes
+        if values.dtype == object:
+            # nbytes only counts the references, not the strings
+            nbytes += sum(sys.getsizeof(v) for v in values)
+    return nbytes
+
+
+class QueryCache(object):
+    """LRU cache of query results, shared by all sessions.
+
+    The cache holds at most max_bytes of data, as given by the nbytes passed
+    to put. Entries expire after max_age seconds, and all entries are dropped
+    when the data of either query backend changes, i.e. the database file or
+    the column store of the table (see app_data.table_columns). Counts hits
+    and misses.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2, max_age=600):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stamp = None
+
+    def get(self, key):
+        """Return cached value or None."""
+        from app_data import file_stamp
+        from import_db import db_file, store_index, table_store
+
+        stamp = file_stamp(db_file, store_index(table_store))
+        with self._lock:
+            if stamp != self._stamp:
+                self._entries.clear()
+                self.nbytes = 0
+                self._stamp = stamp
+
+            entry = self._entries.pop(key, None)
+            if entry is not None and time.time() - entry[1] > self.max_age:
+                self.nbytes -= entry[2]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._entries[key] = (value, time.time(), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][2]
+
+    def stats(self):
+        return dict(size=len(self._entries), nbytes=self.nbytes,
+                    hits=self.hits, misses=self.misses)
+
+
+query_cache = QueryCache(max_bytes=query_cache_max_bytes,
+                         max_age=query_cache_max_age)
+
+
+def collect_cache_metrics():
+    """Return statistics of the query cache for metrics.render."""
+    stats = query_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return [
+        ("query_cache_hits_total", "counter",
+         "Queries served from the query cache.", [({}, stats["hits"])]),
+        ("query_cache_misses_total", "counter",
+         "Queries not found in the query cache.", [({}, stats["misses"])]),
+        ("query_cache_hit_ratio", "gauge",
+         "Fraction of queries served from the query cache.",
+         [({}, float(stats["hits"]) / lookups if lookups else 0.)]),
+        ("query_cache_entries", "gauge", "Entries of the query cache.",
+         [({}, stats["size"])]),
+        ("query_cache_bytes", "gauge", "Size of the data in the query cache.",
+         [({}, stats["nbytes"])]),
+    ]
+
+
+collectors.append(collect_cache_metrics)
+
+
+def get_cache_key(projections, filters, viewport):
+    """Return canonical form of the arguments of a query."""
+    canonical = []
+    for column, operator, values in filters:
+        values = tuple(values) if operator == "between" else tuple(
+            sorted(values))
+        canonical.append((column, operator, values))
+    if viewport is not None:
+        viewport = tuple(tuple(r) for r in viewport)
+    return (tuple(projections), tuple(sorted(canonical)), max_points,
+            viewport)
+
+
+def cached(get_data):
+    """Serve results of a get_data function from the query cache.
+
+    Both the data and the info text are cached. Cached arrays are shared
+    between sessions and therefore made read-only. Viewport queries, which
+    rarely repeat, and random samples, which should differ per query, bypass
+    the cache.
+    """
+
+    @functools.wraps(get_data)
+    def get_data_cached(projections, filters, viewport=None):
+        if viewport is not None or sample_order == "random":
+            return get_data(projections, filters, viewport=viewport)
+        key = (get_data.__name__,) + get_cache_key(projections, filters,
+                                                   viewport)
+        result = query_cache.get(key)
+        if result is None:
+            result = get_data(projections, filters, viewport=viewport)
+            for values in result[0].values():
+                if isinstance(values, np.ndarray):
+                    values.flags.writeable = False
+            query_cache.put(key, result, get_nbytes(result[0]))
+        return result
+
+    return get_data_cached
+
+
+def get_sample_indices(columns, indices, projections):
+    """Sample max_points out of the row indices matching a query.
+
+    Same order as get_sample_order, using stable sorts.
+    """
+    from import_db import get_lod_column
+
+    if sample_order == "random":
+        indices = np.random.permutation(indices)
+    elif sample_order in columns:
+        order = np.argsort(columns[sample_order][indices], kind="mergesort")
+        indices = indices[order]
+    lod_column = get_lod_column(projections[0], projections[1])
+    if lod_column in columns:
+        order = np.argsort(columns[lod_column][indices], kind="mergesort")
+        indices = indices[order]
+    return np.sort(indices[:max_points])
+
+
+@timed("get_data_memory")
+def get_data_memory(projections, filters, viewport=None):
+    """Query in-memory copy of the database.
+
+    The structures table is loaded once per server process into read-only
+    NumPy arrays that are shared between all sessions; filters are evaluated
+    as boolean masks. See get_data_sqla for the arguments and return value.
+    """
+    from app_data import get_table_columns
+
+    columns = get_table_columns()
+
+    mask = np.ones(len(columns["name"]), dtype=bool)
+    for column, operator, values in filters:
+        data = columns[column]
+        if operator == "between":
+            mask &= (data >= values[0]) & (data <= values[1])
+        else:
+            mask &= np.isin(data, values)
+    if viewport is not None:
+        for label, (start, end) in zip(projections, viewport):
+            data = columns[label]
+            mask &= (data >= start) & (data <= end)
+
+    indices = np.flatnonzero(mask)
+    nresults = len(indices)
+    if nresults > max_points:
+        indices = get_sample_indices(columns, indices, projections)
+
+    observe_size("get_data_memory", len(indices))
+    if not nresults:
+        return data_empty, get_plot_info(nresults)
+
+    data = get_plot_data(projections,
+                         *[columns[label][indices] for label in projections])
+    return data, get_plot_info(nresults)
+
+
+def get_plot_data(projections, x, y, clrs, sampled, names, filenames):
+    """Map projected columns to the columns of the plot data source.
+
+    All columns are NumPy arrays; numeric ones are passed to bokeh as float
+    arrays, which are transferred as binary buffers instead of JSON lists.
+    Columns of the database are typed REAL already, in which case no
+    conversion (or copy) is needed.
+    """
+    is_sampled = sampled == "sampled"
+
+    if projections[2] != "group":
+        clrs = np.asarray(clrs, dtype=float)
 
     return dict(
-        x=x, y=y, filename=filenames, color=clrs, sampled=sampled_, name=names, lw=lw
+        x=np.asarray(x, dtype=float),
+        y=np.asarray(y, dtype=float),
+        filename=filenames,
+        color=clrs,
+        sampled=np.where(is_sampled, 20.0, 10.0),
+        name=names,
+        lw=np.where(is_sampled, 2.0, 0.1),
     )
 
 
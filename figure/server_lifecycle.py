@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Lifecycle hooks of the figure app.
+
+on_server_loaded runs once per server process, the session hooks count
+sessions for the metrics (see metrics.py). See
+https://bokeh.pydata.org/en/1.3.4/docs/user_guide/server.html#lifecycle-hooks
+"""
+from __future__ import print_function
+import collections
+import logging
+import time
+from os.path import join
+
+from bokeh.models.widgets import RangeSlider, CheckboxButtonGroup
+
+import config
+import metrics
+from config import quantities, presets
+
+
+def get_preset_filters(preset):
+    """Return filter widgets in the state set by load_preset in main.py."""
+    filters_dict = collections.OrderedDict()
+    for q in config.filter_list:
+        v = quantities[q]
+        if v["type"] == "float":
+            filters_dict[q] = RangeSlider(start=v["range"][0],
+                                          end=v["range"][1],
+                                          value=preset.get(q, v["range"]),
+                                          step=0.1)
+        elif v["type"] == "list":
+            values = preset.get(q, v["values"])
+            filters_dict[q] = CheckboxButtonGroup(
+                labels=list(map(str, v["values"])),
+                active=[v["values"].index(value) for value in values],
+                tags=v["values"])
+    return filters_dict
+
+
+def on_server_loaded(server_context):  # pylint: disable=unused-argument
+    """Warm up caches before the first session is created.
+
+    Runs the query of the default preset, such that the initial update() of
+    new sessions is served from the query cache, and reads the static files.
+    """
+    from figure.query import (cached, get_active_filters, get_data_sqla,
+                              get_data_memory)
+    from app_data import get_table, get_table_columns, get_text_file
+
+    start = time.time()
+    get_text_file(join(config.static_dir, "description.html"))
+
+    if config.query_backend == "memory":
+        get_table_columns()
+        get_data = get_data_memory
+    else:
+        get_table()
+        get_data = get_data_sqla
+    if config.query_cache_max_bytes:
+        preset = presets["default"]
+        projections = [
+            preset["x"], preset["y"], preset["clr"], "sampled", "name",
+            "filename"
+        ]
+        cached(get_data)(projections,
+                         get_active_filters(get_preset_filters(preset),
+                                            quantities))
+
+    logging.info("Warmed up figure app in %.2fs", time.time() - start)
+
+
+def on_session_created(session_context):  # pylint: disable=unused-argument
+    metrics.session_created("figure")
+
+
+def on_session_destroyed(session_context):  # pylint: disable=unused-argument
+    metrics.session_destroyed("figure")
@@ -5,26 +5,56 @@
 
 from __future__ import print_function
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 import re
 import os
+import json
+import time
+import collections
 
 folder_db = 'data'
 structure_folder = os.path.join(folder_db, 'structures')
 rdf_folder = os.path.join(folder_db, 'rdfs')
+rdf_columns = ['index', 'distance', 'histogram', 'unnormalized']
 structure_extension = 'cif'
 properties_csv = os.path.join(folder_db, 'properties.csv')
+tailcorrection_csv = os.path.join(folder_db, 'tailcorrection_data.csv')
+no_tailcorrection_csv = os.path.join(folder_db, 'no_tailcorrection_data.csv')
+# columnar copies of the data, memory-mapped by all server processes
+store_folder = os.path.join(folder_db, 'store')
+table_store = os.path.join(store_folder, 'structures')
+tailcorrection_store = os.path.join(store_folder, 'tailcorrection')
+no_tailcorrection_store = os.path.join(store_folder, 'no_tailcorrection')
+rdf_store = os.path.join(store_folder, 'rdfs')
+results_stores = [tailcorrection_store, no_tailcorrection_store]
+figure_static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'figure', 'static')
 table_name = 'structures'  # parameters will be put in this database
-db_params = 'sqlite:///{}/database.db'.format(folder_db)
-
-# when storing structures on an object store
-#os_url = "https://object.cscs.ch/v1/AUTH_b1d80408b3d340db9f03d373bbde5c1e/discover-cofs/test_data/structures"
-
-data = None
+units_table_name = 'units'  # units of the parameters
+sample_key = 'sample_key'  # random order used to subsample large query results
+row_hash = 'row_hash'  # content hash per row used by the incremental import
+# 2d projections with precomputed levels of detail, see fill_lod_levels
+lod_projections = [('pca_1', 'pca_2'), ('mds_1', 'mds_2')]
+lod_nlevels = 10  # the finest level divides the plane into 2**10 x 2**10 cells
+lod_columns = ['lod_{}_{}'.format(x, y) for x, y in lod_projections]
+# columns added by the importer, not to be shown as properties
+internal_columns = [sample_key, row_hash] + lod_columns
+db_file = os.path.join(folder_db, 'database.db')
+db_params = 'sqlite:///{}'.format(db_file)
+
+# when storing structures on an object store, set STRUCTURES_URL, e.g. to
+# https://object.cscs.ch/v1/AUTH_b1d80408b3d340db9f03d373bbde5c1e/discover-cofs/test_data/structures
+os_url = os.environ.get('STRUCTURES_URL')
+os_cache_folder = os.path.join(folder_db, 'cache', 'structures')
+
+# URL template for structure files served next to the apps (set by serve.py).
+# If None, the detail app embeds structures into the page instead.
+structure_url = None
 
 engine = sqlalchemy.create_engine(db_params, echo=False)
-pandas_sql = pd.io.sql.pandasSQL_builder(engine, schema=None)
+
 
 columns_json = {}
 
@@ -40,96 +70,414 @@ def parse_csv(path):
 
 def add_filenames(data):
     print("Adding filenames")
-    fnames = [
-        "{}.{}".format(row['name'], structure_extension)
-        for _index, row in data.iterrows()
-    ]
-    data['filename'] = fnames
+    data['filename'] = data['name'].astype(str) + '.' + structure_extension
     return data
 
 
-# pylint: disable=too-many-arguments
-def to_sql_k(self,
-             frame,
-             name,
-             if_exists='fail',
-             index=True,
-             index_label=None,
-             schema=None,
-             chunksize=None,
-             dtype=None,
-             **kwargs):
-    if dtype is not None:
-        from sqlalchemy.types import to_instance, TypeEngine
-        for col, my_type in dtype.items():
-            if not isinstance(to_instance(my_type), TypeEngine):
-                raise ValueError('The type of %s is not a SQLAlchemy '
-                                 'type ' % col)
-
-    table = pd.io.sql.SQLTable(name,
-                               self,
-                               frame=frame,
-                               index=index,
-                               if_exists=if_exists,
-                               index_label=index_label,
-                               schema=schema,
-                               dtype=dtype,
-                               **kwargs)
-    table.create()
-    table.insert(chunksize)
+def add_sample_key(data, seed=0):
+    """Add column with a uniformly distributed random number per row.
+
+    Ordering by this column yields a random sample of any query result
+    without having to sort by random() at query time.
+    """
+    print("Adding sample key")
+    data[sample_key] = np.random.RandomState(seed).random_sample(len(data))
+    return data
 
 
-def rename_columns(data):
-    """Rename columns.
+def add_row_hashes(data):
+    """Add column with a hash of the content of each row.
 
-    Need to rename columns to valid python variable names.
+    The incremental import compares these hashes to find rows that have
+    changed. Numeric columns are hashed as floats, such that the hash does not
+    depend on the dtype inferred by pandas (e.g. for chunks of the file).
     """
-    print("Renaming columns")
-    labels = data.keys()
-    #rep_dict = { l: l.replace(' ', '_') for l in labels }
-    #data.rename(index=str, columns=rep_dict, inplace=True)
+    print("Adding row hashes")
+    columns = [c for c in data.columns if c not in ('id', sample_key, row_hash)]
+    content = data[columns].apply(lambda c: c.astype(np.float64)
+                                  if c.dtype.kind in 'biuf' else c)
+    data[row_hash] = pd.util.hash_pandas_object(
+        content, index=False).values.view(np.int64)
+    return data
+
+
+unit_regex = re.compile(r'\[(.*?)\]')
+
+
+def parse_labels(labels):
+    """Split units off column labels.
 
-    unit_regex = re.compile('\[(.*?)\]')
+    Returns mapping from labels to valid python variable names and mapping
+    from new labels to their units (for labels with units in brackets).
+    """
+    rename = {}
+    units = {}
     for label in labels:
         match = re.search(unit_regex, label)
-        # provide units as separate column
         if match:
-            units = match.group(1).strip()
             label_new = re.sub(unit_regex, '', label).strip().replace(' ', '_')
-            data.rename(index=str, columns={label: label_new}, inplace=True)
-            data[label_new + '_units'] = units
+            units[label_new] = match.group(1).strip()
         else:
             label_new = label.replace(' ', '_')
-            data.rename(index=str, columns={label: label_new}, inplace=True)
+        rename[label] = label_new
+    return rename, units
 
-    return data
 
+def rename_columns(data):
+    """Rename columns.
 
-def fill_db():
-    #data.to_sql(table_name, con=engine, if_exists='replace')
+    Need to rename columns to valid python variable names.
+    Units are removed from the labels and returned separately, see
+    parse_labels.
+    """
+    print("Renaming columns")
+    rename, units = parse_labels(data.keys())
+    data.rename(columns=rename, inplace=True)
+
+    return data, units
+
+
+def get_column_types(frame):
+    """Return SQL types of the columns of the structures table.
+
+    Types of columns described in figure/static/columns.yml follow their
+    metadata (float: REAL, list: TEXT), other columns are typed by their
+    dtype.
+    """
+    import yaml
+
+    with open(os.path.join(figure_static_dir, 'columns.yml'), 'r') as f:
+        metadata = {q['column']: q['type'] for q in yaml.safe_load(f)}
+
+    types = collections.OrderedDict()
+    for column in frame.columns:
+        if column == 'id':
+            types[column] = 'INTEGER PRIMARY KEY'
+        elif column == 'name':
+            types[column] = 'TEXT NOT NULL UNIQUE'
+        elif column == row_hash:
+            types[column] = 'INTEGER'
+        elif column in metadata:
+            types[column] = 'REAL' if metadata[column] == 'float' else 'TEXT'
+        elif frame[column].dtype.kind in 'biuf':
+            types[column] = 'REAL'
+        else:
+            types[column] = 'TEXT'
+    return types
+
+
+def create_table(cursor, frame):
+    """(Re)create structures table for the columns of a data frame.
+
+    The table has an integer primary key and a unique name column, as
+    required by the ORM queries of the detail app.
+    """
+    cursor.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+    cursor.execute('CREATE TABLE {} ({})'.format(
+        table_name, ', '.join('"{}" {}'.format(c, t)
+                              for c, t in get_column_types(frame).items())))
+
+
+def fill_db(data):
+    """Replace structures table by data in a single transaction."""
     print("Filling database")
-    to_sql_k(pandas_sql,
-             data,
-             table_name,
-             index=True,
-             index_label='id',
-             keys='id',
-             if_exists='replace')
+    data.insert(0, 'id', np.arange(len(data)))
+
+    con = engine.raw_connection()
+    try:
+        cursor = con.cursor()
+        cursor.execute('BEGIN')
+        create_table(cursor, data)
+        insert_rows(cursor, data)
+        con.commit()
+    finally:
+        con.close()
 
     with engine.connect() as con:
         test = pd.read_sql("SELECT * FROM {} LIMIT 5".format(table_name), con)
     print(test)
 
 
+def import_csv_chunked(path, chunksize):
+    """Import properties from CSV file in chunks of rows.
+
+    Only one chunk is held in memory at a time. Each chunk is prepared like
+    the full data set in the default import and inserted with executemany.
+    All chunks are inserted in a single transaction, with journaling and
+    syncing to disk relaxed during the load.
+
+    Returns units of the columns, see parse_labels.
+    """
+    print("Filling database in chunks of {} rows".format(chunksize))
+    units = {}
+    nrows = 0
+    start = time.time()
+
+    con = engine.raw_connection()
+    try:
+        cursor = con.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.execute('BEGIN')
+
+        chunks = pd.read_csv(path, chunksize=chunksize, skipinitialspace=True)
+        for i, chunk in enumerate(chunks):
+            chunk = add_filenames(chunk)
+            chunk = add_sample_key(chunk, seed=i)
+            chunk, chunk_units = rename_columns(chunk)
+            chunk = add_row_hashes(chunk)
+            units.update(chunk_units)
+            chunk.insert(0, 'id', np.arange(nrows, nrows + len(chunk)))
+
+            if i == 0:
+                create_table(cursor, chunk)
+            insert_rows(cursor, chunk)
+
+            nrows += len(chunk)
+            print("Inserted {} rows ({:.0f} rows/s)".format(
+                nrows, nrows / (time.time() - start)))
+
+        con.commit()
+        cursor.execute('PRAGMA synchronous=FULL')
+        cursor.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        con.close()
+
+    return units
+
+
+def insert_rows(cursor, frame, replace=False):
+    """Insert rows of data frame into structures table with executemany.
+
+    With replace=True, rows with the same id or name are replaced.
+    """
+    insert = 'INSERT {}INTO {} ({}) VALUES ({})'.format(
+        'OR REPLACE ' if replace else '', table_name,
+        ', '.join('"{}"'.format(c) for c in frame),
+        ', '.join(['?'] * len(frame.columns)))
+    # convert to python objects, with None for missing values
+    rows = frame.astype(object).where(frame.notnull(), None)
+    cursor.executemany(insert, rows.values.tolist())
+
+
+def update_db(data):
+    """Update structures table with changed rows only.
+
+    Rows are matched by name and compared by their row hash. New and changed
+    rows are upserted, rows missing from data are deleted. Existing rows keep
+    their id and sample key. All changes, including the resulting changes of
+    the levels of detail, are applied in a single transaction, so readers see
+    either the old or the new table.
+
+    Returns the number of new, changed and removed rows. Returns None without
+    touching the database, if the table does not exist yet or its columns
+    differ from data (requires a full import).
+    """
+    print("Updating database")
+    inspector = sqlalchemy.inspect(engine)
+    if table_name not in inspector.get_table_names():
+        print("Table {} does not exist".format(table_name))
+        return None
+    # levels of detail are computed from the data, see update_lod_levels
+    columns = set(c['name'] for c in inspector.get_columns(table_name))
+    columns -= set(lod_columns)
+    if columns != set(data.columns) | set(['id', sample_key]):
+        print("Columns of table {} have changed".format(table_name))
+        return None
+
+    with engine.connect() as con:
+        existing = pd.read_sql(
+            'SELECT name, id, {}, {} FROM {}'.format(sample_key, row_hash,
+                                                     table_name),
+            con,
+            index_col='name')
+    existing.index = existing.index.astype(str)
+    existing['id'] = existing['id'].astype(np.int64)
+
+    old = existing.reindex(data['name'].astype(str))
+    is_new = old['id'].isnull().values
+    changed = is_new | (old[row_hash].values != data[row_hash].values)
+    removed = existing.index.difference(data['name'].astype(str))
+
+    data = data[changed].copy()
+    is_new = is_new[changed]
+    ids = old['id'].values[changed]
+    keys = old[sample_key].values[changed]
+    next_id = existing['id'].max() + 1 if len(existing) else 0
+    ids[is_new] = np.arange(next_id, next_id + is_new.sum())
+    keys[is_new] = np.random.RandomState().random_sample(is_new.sum())
+    data.insert(0, 'id', ids.astype(np.int64))
+    data[sample_key] = keys
+
+    con = engine.raw_connection()
+    try:
+        cursor = con.cursor()
+        cursor.execute('BEGIN')
+        cursor.executemany(
+            'DELETE FROM {} WHERE name = ?'.format(table_name),
+            [(name,) for name in removed])
+        insert_rows(cursor, data, replace=True)
+        # upserted rows have no levels of detail yet
+        if len(data) or len(removed):
+            update_lod_levels(con)
+        con.commit()
+    finally:
+        con.close()
+
+    print("Added {} new, updated {} changed and deleted {} removed rows".format(
+        is_new.sum(), len(data) - is_new.sum(), len(removed)))
+    return len(data) + len(removed)
+
+
+def fill_units(units):
+    """Store units of the columns in a separate table."""
+    print("Storing units")
+    df = pd.DataFrame(sorted(units.items()), columns=['quantity', 'unit'])
+    df.to_sql(units_table_name, con=engine, if_exists='replace', index=False)
+
+
+def get_filter_columns():
+    """Return columns that can be filtered on in the figure app.
+
+    Filters are read from figure/static/filters.yml and restricted to the
+    columns described in figure/static/columns.yml.
+    """
+    import yaml
+
+    with open(os.path.join(figure_static_dir, 'columns.yml'), 'r') as f:
+        columns = [q['column'] for q in yaml.safe_load(f)]
+    with open(os.path.join(figure_static_dir, 'filters.yml'), 'r') as f:
+        filters = yaml.safe_load(f)
+
+    return [c for c in filters if c in columns]
+
+
+def get_lod_column(x, y):
+    """Return column with levels of detail of projection x, y (or None)."""
+    for (lod_x, lod_y), column in zip(lod_projections, lod_columns):
+        if set([x, y]) == set([lod_x, lod_y]):
+            return column
+    return None
+
+
+def get_lod_levels(x, y, order, nlevels=lod_nlevels):
+    """Return level of detail of each point of a 2d projection.
+
+    At level l, the bounding box of the points is divided into a grid of
+    2**l x 2**l cells and the first point of each cell (in the given order)
+    is assigned level l, unless it is on a coarser level already. Remaining
+    points (and points with missing coordinates) are assigned nlevels.
+
+    Selecting points up to some level thus yields a thinned-out version of
+    the projection that still covers all regions containing points, and
+    ordering by level yields a sample of any size with this property.
+    """
+    levels = np.full(len(x), nlevels, dtype=np.int64)
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if not len(valid):
+        return levels
+    indices = valid[np.argsort(order[valid], kind='mergesort')]
+
+    def normalize(values):
+        span = values.max() - values.min()
+        return (values - values.min()) / (span if span > 0 else 1.0)
+
+    x_norm = normalize(x[indices])
+    y_norm = normalize(y[indices])
+    for level in range(nlevels):
+        n = 2**level
+        cells = (np.minimum((x_norm * n).astype(np.int64), n - 1) * n +
+                 np.minimum((y_norm * n).astype(np.int64), n - 1))
+        # return_index yields the first point of each cell
+        _, first = np.unique(cells, return_index=True)
+        first = indices[first]
+        levels[first] = np.minimum(levels[first], level)
+    return levels
+
+
+def update_lod_levels(con):
+    """Store levels of detail of the projections in lod_projections.
+
+    Levels are computed from the full table (and thus also after chunked or
+    incremental imports). Only rows whose level has changed are updated.
+    Runs in the open transaction of the raw connection con.
+    """
+    cursor = con.cursor()
+    cursor.execute('PRAGMA table_info({})'.format(table_name))
+    existing = set(row[1] for row in cursor.fetchall())
+
+    for (x, y), column in zip(lod_projections, lod_columns):
+        if x not in existing or y not in existing:
+            continue
+        if column not in existing:
+            cursor.execute('ALTER TABLE {} ADD COLUMN "{}" INTEGER'.format(
+                table_name, column))
+        # pd.read_sql only supports sqlalchemy connections, not raw ones
+        cursor.execute('SELECT id, "{}", "{}", "{}", "{}" FROM {}'.format(
+            x, y, sample_key, column, table_name))
+        df = pd.DataFrame.from_records(
+            cursor.fetchall(),
+            columns=['id', x, y, sample_key, column],
+            coerce_float=True)
+        levels = get_lod_levels(df[x].values.astype(float),
+                                df[y].values.astype(float),
+                                df[sample_key].values)
+        changed = (df[column] != levels).values
+        cursor.executemany(
+            'UPDATE {} SET "{}" = ? WHERE id = ?'.format(table_name, column),
+            zip(levels[changed].tolist(), df['id'][changed].tolist()))
+        print("Updated {} levels of {}".format(changed.sum(), column))
+
+
+def fill_lod_levels():
+    """Store levels of detail in a transaction, see update_lod_levels."""
+    print("Computing levels of detail")
+    con = engine.raw_connection()
+    try:
+        con.cursor().execute('BEGIN')
+        update_lod_levels(con)
+        con.commit()
+    finally:
+        con.close()
+
+
+def create_indices(analyze=True):
+    """Create indices used by the figure app.
+
+    Indices cover the filters, ordering by level of detail and the visible
+    ranges of projections. Afterwards, statistics are gathered such that the
+    sqlite query planner can make use of the indices, unless analyze is
+    False (e.g. after small incremental updates, where the statistics of the
+    whole table hardly change).
+    """
+    print("Creating indices")
+    with engine.begin() as con:
+        for column in get_filter_columns():
+            con.execute('CREATE INDEX IF NOT EXISTS "ix_{0}_{1}" '
+                        'ON {0} ("{1}")'.format(table_name, column))
+        # sampling a projection orders by its level of detail
+        columns = [c['name'] for c in sqlalchemy.inspect(con).get_columns(
+            table_name)]
+        for column in lod_columns:
+            if column in columns:
+                con.execute('CREATE INDEX IF NOT EXISTS "ix_{0}_{1}" '
+                            'ON {0} ("{1}", "{2}")'.format(
+                                table_name, column, sample_key))
+        # viewport queries select ranges of both coordinates of a projection
+        for x, y in lod_projections:
+            if x in columns and y in columns:
+                con.execute('CREATE INDEX IF NOT EXISTS "ix_{0}_{1}_{2}" '
+                            'ON {0} ("{1}", "{2}")'.format(table_name, x, y))
+        if analyze:
+            con.execute('ANALYZE')
+
+
 def automap_table(engine):
-    """Try to infer model from Database.
-    
-    This currently does not work because
-      1. sqlalchemy can only automap tables with a primary key
-      2. pd.to_sql cannot create tables with a primary key
-      3. sqlite does not allow table structure to be modified after creation
-      
-    See https://stackoverflow.com/a/35397969/1069467 for workarounds
+    """Infer model from Database.
+
+    sqlalchemy can only automap tables with a primary key, which is why the
+    structures table is created explicitly (see create_table) rather than
+    via pd.to_sql.
     """
     from sqlalchemy.ext.automap import automap_base
     Base = automap_base()
@@ -140,48 +488,251 @@ def automap_table(engine):
     return Base.classes.get(table_name)
 
 
-def get_cif_path(filename):
-    from os.path import join, abspath
-    return abspath(join(structure_folder, filename))
+def store_index(folder):
+    return os.path.join(folder, 'index.json')
+
+
+def get_sources(paths):
+    """Return names, modification times and sizes of the input files of a
+    store, as recorded in its index by pack_columns."""
+    sources = []
+    for path in paths:
+        st = os.stat(path)
+        sources.append([os.path.basename(path), st.st_mtime, st.st_size])
+    return sources
 
 
-def get_cif_content_from_disk(filename):
-    """Load CIF content from disk."""
-    with open(get_cif_path(filename), 'r') as f:
-        content = f.read()
-    return content
+def is_packed(folder, sources):
+    """Return whether the store in folder was packed from these sources."""
+    try:
+        with open(store_index(folder), 'r') as f:
+            return json.load(f).get('sources') == sources
+    except (IOError, OSError, ValueError):
+        return False
 
 
-def get_cif_content_from_os(filename):
-    """Load CIF content via GET request from object store."""
-    import requests
+def store_column(folder, version, i, null=False):
+    """Return path of column i (or its mask of missing values) of a store."""
+    return os.path.join(
+        folder, '{}.{}{}.npy'.format(version, i, '.null' if null else ''))
 
-    url = "{}/{}".format(os_url, filename)
-    print(url)
-    data = requests.get(url)
-    return data.content
 
+def pack_columns(columns, folder, **index):
+    """Store columns in .npy files that can be memory-mapped.
 
-def get_rdf_dataframe_from_disk(name):
+    columns is an iterable of (label, values) pairs, which is consumed one
+    column at a time. Non-numeric columns are stored as unicode strings, with
+    a separate mask for missing values.
+
+    The files of each call are named by a new version, which is recorded in
+    the index file (along with the columns and further index entries). The
+    index is replaced atomically once all columns are written, so running
+    apps switch from the complete old version to the complete new one.
+    Files of older versions are removed, except for the previous version,
+    which apps may still be loading.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    previous = None
+    if os.path.exists(store_index(folder)):
+        with open(store_index(folder), 'r') as f:
+            previous = json.load(f).get('version')
+    version = '{:d}'.format(int(time.time() * 1e6))
+
+    labels = []
+    nulls = []
+    for i, (label, values) in enumerate(columns):
+        values = pd.Series(values)
+        if values.dtype.kind in 'biuf':
+            np.save(store_column(folder, version, i), values.values)
+        else:
+            isnull = values.isnull().values
+            values = np.where(isnull, '', values.astype(str).values)
+            np.save(store_column(folder, version, i), values.astype(str))
+            if isnull.any():
+                np.save(store_column(folder, version, i, null=True), isnull)
+                nulls.append(label)
+        labels.append(label)
+
+    index.update(version=version, columns=labels, nulls=nulls)
+    with open(store_index(folder) + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(store_index(folder) + '.tmp', store_index(folder))
+
+    for filename in os.listdir(folder):
+        if filename.endswith('.npy') and filename.split('.')[0] not in (
+                version, previous):
+            os.remove(os.path.join(folder, filename))
+
+
+def pack_table():
+    """Store columns of the structures table for memory-mapping."""
+    print("Packing structures table")
+    with engine.connect() as con:
+        labels = [
+            c['name']
+            for c in sqlalchemy.inspect(con).get_columns(table_name)
+        ]
+
+        def read_columns():
+            for label in labels:
+                yield label, pd.read_sql(
+                    'SELECT "{}" FROM {} ORDER BY id'.format(
+                        label, table_name), con)[label].values
+
+        pack_columns(read_columns(), table_store)
+
+
+def parse_rdf_csv(name):
     df = pd.read_csv(os.path.join(rdf_folder, name + '.csv'),
-                     names=['index', 'distance', 'histogram', 'unnormalized'],
+                     names=rdf_columns,
                      comment='#',
                      sep='\s+')
     return df
 
 
+def count_rdf_rows(name):
+    """Return number of rows parse_rdf_csv returns, without parsing."""
+    with open(os.path.join(rdf_folder, name + '.csv'), 'r') as f:
+        return sum(1 for line in f
+                   if line.strip() and not line.lstrip().startswith('#'))
+
+
+def pack_rdfs():
+    """Store RDFs of all structures for memory-mapping.
+
+    The RDFs are stacked into one float64 column per entry of rdf_columns,
+    and the index maps each structure name to its (start, stop) rows. Skipped
+    if no RDF file has changed since the last call.
+
+    The rows of each file are counted first, so that the RDFs can be written
+    to a memory-mapped temporary file rather than being held in memory.
+    """
+    filenames = sorted(f for f in os.listdir(rdf_folder)
+                       if os.path.splitext(f)[1] == '.csv')
+    sources = get_sources(
+        [os.path.join(rdf_folder, filename) for filename in filenames])
+    if is_packed(rdf_store, sources):
+        print("RDFs are unchanged")
+        return
+
+    print("Packing RDFs")
+    names = [os.path.splitext(filename)[0] for filename in filenames]
+    index = {}
+    start = 0
+    for name in names:
+        index[name] = (start, start + count_rdf_rows(name))
+        start = index[name][1]
+
+    if not os.path.isdir(rdf_store):
+        os.makedirs(rdf_store)
+    tmp_path = os.path.join(rdf_store, 'rdfs.tmp')
+    shape = (start, len(rdf_columns))
+    # columns are contiguous in Fortran order, as needed by pack_columns
+    if start:
+        values = np.lib.format.open_memmap(tmp_path,
+                                           mode='w+',
+                                           dtype=np.float64,
+                                           shape=shape,
+                                           fortran_order=True)
+    else:
+        values = np.empty(shape)
+    try:
+        for name in names:
+            start, stop = index[name]
+            values[start:stop] = parse_rdf_csv(name).values
+        pack_columns(zip(rdf_columns, values.T),
+                     rdf_store,
+                     rows=index,
+                     sources=sources)
+    finally:
+        del values
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print("Packed {} RDFs".format(len(index)))
+
+
 def get_results_dataframes_from_disk():
-    df_tailcorrection = pd.read_csv(
-        os.path.join(folder_db, 'tailcorrection_data.csv'))
-    df_no_tailcorrection = pd.read_csv(
-        os.path.join(folder_db, 'no_tailcorrection_data.csv'))
+    df_tailcorrection = pd.read_csv(tailcorrection_csv)
+    df_no_tailcorrection = pd.read_csv(no_tailcorrection_csv)
 
     return df_tailcorrection, df_no_tailcorrection
 
 
+def pack_results():
+    """Store results with and without tail-corrections for memory-mapping.
+
+    Rows are sorted by name, and the index maps each name to its
+    (start, stop) rows. Skipped if the CSV files have not changed since the
+    last call.
+    """
+    sources = get_sources([tailcorrection_csv, no_tailcorrection_csv])
+    if all(is_packed(folder, sources) for folder in results_stores):
+        print("Results are unchanged")
+        return
+
+    print("Packing results")
+    for df, folder in zip(get_results_dataframes_from_disk(), results_stores):
+        names = df['name'].astype(str).values
+        order = np.argsort(names, kind='mergesort')
+        df, names = df.iloc[order], names[order]
+        unique, starts = np.unique(names, return_index=True)
+        stops = np.append(starts[1:], len(names))
+        rows = {
+            name: (int(start), int(stop))
+            for name, start, stop in zip(unique, starts, stops)
+        }
+        pack_columns(df.items(), folder, rows=rows, sources=sources)
+
+
 if __name__ == "__main__":
-    data = parse_csv(properties_csv)
-    data = add_filenames(data)
-    rename_columns(data)
-    fill_db()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import properties into "
+                                     "sqlite database")
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help="only update rows that have changed instead of "
+                        "replacing the table")
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=None,
+                        help="stream CSV file in chunks of this many rows "
+                        "(for files that do not fit into memory)")
+    args = parser.parse_args()
+
+    updated = None  # number of rows changed by update_db
+    if args.incremental:
+        data = parse_csv(properties_csv)
+        data = add_filenames(data)
+        data, units = rename_columns(data)
+        data = add_row_hashes(data)
+        updated = update_db(data)
+        if updated is None:
+            data = add_sample_key(data)
+            fill_db(data)
+    elif args.chunksize:
+        units = import_csv_chunked(properties_csv, args.chunksize)
+    else:
+        data = parse_csv(properties_csv)
+        data = add_filenames(data)
+        data = add_sample_key(data)
+        data, units = rename_columns(data)
+        data = add_row_hashes(data)
+        fill_db(data)
+    fill_units(units)
+    if updated is None:
+        fill_lod_levels()
+        create_indices()
+    else:
+        # levels of detail were updated by update_db already
+        create_indices(analyze=False)
     automap_table(engine)
+    if os.path.isdir(rdf_folder):
+        pack_rdfs()
+    if updated != 0 or not os.path.exists(store_index(table_store)):
+        pack_table()
+    if os.path.exists(tailcorrection_csv) and os.path.exists(
+            no_tailcorrection_csv):
+        pack_results()
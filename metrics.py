@@ -0,0 +1,177 @@
+# coding: utf-8
+"""Timings and sizes of the hot paths of the apps.
+
+Durations of instrumented operations are recorded with timed, e.g.
+
+    with timed("get_data_sqla.execute"):
+        ...
+
+or by decorating a function with @timed("create_plot"). Other modules add
+their own values (e.g. cache statistics) by appending to collectors.
+
+All values are kept per process and rendered in Prometheus text format by
+render, which serve.py serves at /metrics. Every sample is labeled with the
+pid of the process, so that series of different worker processes are kept
+apart. If log_timings is set, each observation is also logged as a JSON line.
+"""
+
+from __future__ import print_function
+
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+prefix = 'app_'  # prefix of all metric names
+# upper bounds of the histogram buckets of durations, in seconds
+duration_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1., 2.5, 5., 10.)
+log_timings = False  # log each observation as JSON (see serve.py)
+
+logger = logging.getLogger(__name__)
+lock = threading.Lock()
+durations = {}  # operation: [count per bucket, ..., count, sum]
+sizes = {}  # query: [count, sum of rows]
+sessions_created = collections.Counter()  # by app
+sessions_active = collections.Counter()  # by app
+
+# functions returning further metrics as (name, type, help, samples) tuples,
+# where samples is a list of (labels, value) pairs, or of (suffix, labels,
+# value) for histograms and summaries
+collectors = []
+
+
+def log(**fields):
+    fields.update(pid=os.getpid(), time=time.time())
+    logger.info(json.dumps(fields, sort_keys=True))
+
+
+def observe_duration(operation, seconds):
+    """Record duration of an operation."""
+    with lock:
+        values = durations.setdefault(operation,
+                                      [0] * (len(duration_buckets) + 2))
+        for i, bound in enumerate(duration_buckets):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += 1
+        values[-1] += seconds
+    if log_timings:
+        log(operation=operation, seconds=seconds)
+
+
+def observe_size(query, rows):
+    """Record number of rows of a query result."""
+    with lock:
+        values = sizes.setdefault(query, [0, 0])
+        values[0] += 1
+        values[1] += rows
+    if log_timings:
+        log(query=query, rows=rows)
+
+
+class timed(object):  # pylint: disable=invalid-name
+    """Context manager and decorator recording the duration of operation."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_duration(self.operation, time.time() - self._start)
+
+    def __call__(self, function):
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            # new instance, since the function may run in several threads
+            with timed(self.operation):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+
+def session_created(app):
+    """Count new session of app; call from on_session_created."""
+    with lock:
+        sessions_created[app] += 1
+        sessions_active[app] += 1
+
+
+def session_destroyed(app):
+    """Count destroyed session of app; call from on_session_destroyed."""
+    with lock:
+        sessions_active[app] -= 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in sorted(labels.items())) + '}'
+
+
+def collect():
+    """Return metrics of this process as (name, type, help, samples)."""
+    with lock:
+        duration_samples = []
+        for operation, values in sorted(durations.items()):
+            for bound, count in zip(duration_buckets, values):
+                duration_samples.append(
+                    ('_bucket', dict(operation=operation, le=repr(bound)),
+                     count))
+            duration_samples += [
+                ('_bucket', dict(operation=operation, le='+Inf'), values[-2]),
+                ('_count', dict(operation=operation), values[-2]),
+                ('_sum', dict(operation=operation), values[-1]),
+            ]
+        size_samples = []
+        for query, (count, total) in sorted(sizes.items()):
+            size_samples += [
+                ('_count', dict(query=query), count),
+                ('_sum', dict(query=query), total),
+            ]
+        created = [(dict(app=k), v)
+                   for k, v in sorted(sessions_created.items())]
+        active = [(dict(app=k), v)
+                  for k, v in sorted(sessions_active.items())]
+
+    results = [
+        ('operation_duration_seconds', 'histogram',
+         'Duration of instrumented operations.', duration_samples),
+        ('result_rows', 'summary', 'Number of rows of query results.',
+         size_samples),
+        ('sessions_created_total', 'counter', 'Bokeh sessions created.',
+         created),
+        ('sessions_active', 'gauge', 'Bokeh sessions currently open.', active),
+    ]
+    for collector in collectors:
+        results += collector()
+    return results
+
+
+def render():
+    """Return metrics of this process in Prometheus text format."""
+    pid = os.getpid()
+    lines = []
+    for name, kind, help_text, samples in collect():
+        name = prefix + name
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample in samples:
+            # histograms and summaries have samples with name suffixes
+            suffix, labels, value = sample if len(sample) == 3 else (
+                '',) + tuple(sample)
+            labels = dict(labels, pid=pid)
+            lines.append('{}{}{} {}'.format(name, suffix,
+                                            format_labels(labels),
+                                            repr(float(value))))
+    return '\n'.join(lines) + '\n'
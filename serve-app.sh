@@ -12,12 +12,13 @@ set -x
 #psql_start
 
 #===============================================================================
-bokeh serve figure detail select-figure  \
+python serve.py figure detail select-figure  \
     --port 5006                 \
     --log-level debug           \
     --allow-websocket-origin "*" \
     --prefix "$BOKEH_PREFIX" \
-    --use-xheaders
+    --use-xheaders \
+    --num-procs "${BOKEH_NUM_PROCS:-1}"
 # --allow-websocket-origin discover.materialscloud.org 
 # --allow-websocket-origin localhost:5006
 
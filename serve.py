@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Serve the bokeh apps together with auxiliary HTTP endpoints.
+
+Equivalent to `bokeh serve <apps>`, plus
+
+ * /structures/<filename>: structure files, fetched on demand by the detail app
+ * /metrics: timings, result sizes, cache statistics and session counts of
+   the serving process in Prometheus text format (see metrics.py)
+
+Responses are gzip-compressed. With --num-procs, the server forks worker
+processes sharing the listening socket. Workers map the column stores written
+by import_db.py from the same files, so the data is held in memory only once.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler, HTTPError
+
+import app_data
+import import_db
+import metrics
+
+STRUCTURES_MAX_AGE = 3600  # seconds browsers may cache structure files
+
+
+class StructureHandler(RequestHandler):
+    """Serve structure files from disk or object store.
+
+    Files are read in the I/O thread pool of the apps, so that fetching from
+    the object store does not block the server. Tornado adds an ETag to every
+    response and answers matching If-None-Match requests with 304 Not
+    Modified.
+    """
+
+    @gen.coroutine
+    def get(self, filename):  # pylint: disable=arguments-differ
+        if os.path.basename(filename) != filename or not filename.endswith(
+                '.' + import_db.structure_extension):
+            raise HTTPError(404)
+
+        if import_db.os_url:
+            get_content = app_data.get_cif_content_from_os
+        else:
+            get_content = app_data.get_cif_content_from_disk
+        try:
+            content = yield IOLoop.current().run_in_executor(
+                app_data.get_executor(), get_content, filename)
+        except (IOError, OSError):
+            raise HTTPError(404)
+
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.set_header('Cache-Control',
+                        'public, max-age={}'.format(STRUCTURES_MAX_AGE))
+        self.write(content)
+
+
+class MetricsHandler(RequestHandler):
+    """Serve metrics of this process in Prometheus text format.
+
+    With several worker processes, each request is answered by one of them;
+    samples are labeled with the pid of the worker.
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
+
+
+def collect_data_metrics():
+    """Return modification time of the database for metrics.render.
+
+    Relates changes of the timings to data refreshes.
+    """
+    try:
+        mtime = os.path.getmtime(import_db.db_file)
+    except OSError:
+        return []
+    return [('database_modified_seconds', 'gauge',
+             'Modification time of the database file.', [({}, mtime)])]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('apps', nargs='+', help="bokeh app directories")
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--address', default=None)
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--allow-websocket-origin',
+                        action='append',
+                        default=None,
+                        help="host that can connect to the websocket")
+    parser.add_argument('--use-xheaders', action='store_true')
+    parser.add_argument('--num-procs',
+                        type=int,
+                        default=1,
+                        help="number of worker processes (0: one per core)")
+    parser.add_argument('--metrics-log',
+                        action='store_true',
+                        help="log timings and result sizes as JSON")
+    parser.add_argument('--log-level',
+                        default='info',
+                        choices=['trace', 'debug', 'info', 'warning', 'error'])
+    return parser
+
+
+def main():
+    from bokeh.command.util import build_single_handler_applications
+    from bokeh.server.server import Server
+    from bokeh.util.logconfig import basicConfig
+
+    args = get_parser().parse_args()
+    basicConfig(level=getattr(logging, args.log_level.upper()),
+                format="%(asctime)s %(message)s")
+
+    # let the detail app fetch structures on demand instead of inlining them
+    import_db.structure_url = "structures/{}"
+    metrics.log_timings = args.metrics_log
+    metrics.collectors.append(collect_data_metrics)
+
+    applications = build_single_handler_applications(args.apps, {})
+    server = Server(
+        applications,
+        port=args.port,
+        address=args.address,
+        prefix=args.prefix,
+        allow_websocket_origin=args.allow_websocket_origin,
+        use_xheaders=args.use_xheaders,
+        extra_patterns=[
+            (r'/structures/(.*)', StructureHandler),
+            (r'/metrics', MetricsHandler),
+        ],
+        compress_response=True,
+        num_procs=args.num_procs,
+    )
+    server.start()
+
+    logging.info("Bokeh apps running at: %s",
+                 ", ".join(server.prefix + p for p in applications))
+    server.run_until_shutdown()
+
+
+if __name__ == '__main__':
+    main()
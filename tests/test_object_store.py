@@ -0,0 +1,127 @@
+# coding: utf-8
+"""Tests of the object store client, against a local HTTP server."""
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from app_data import ObjectStore
+
+ETAG = '"v1"'
+CONTENT = 'data_test\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve CONTENT with ETAG; paths containing "missing" or "error" fail."""
+
+    requests = []  # (path, If-None-Match) of all requests
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        etag = self.headers.get('If-None-Match')
+        Handler.requests.append((self.path, etag))
+        if 'missing' in self.path:
+            self.send_response(404)
+            self.end_headers()
+        elif 'error' in self.path:
+            self.send_response(500)
+            self.end_headers()
+        elif etag == ETAG:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = CONTENT.encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class ObjectStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:{}/structures'.format(
+            cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.requests = []
+        self.cache_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_revalidate_etag(self):
+        store = ObjectStore(self.url, cache_folder=self.cache_folder,
+                            max_age=0)
+        self.assertEqual(store.get('a.cif'), CONTENT)
+        # expired in memory, revalidated with the ETag of the disk cache
+        self.assertEqual(store.get('a.cif'), CONTENT)
+        # disk cache is used by new processes as well
+        store = ObjectStore(self.url, cache_folder=self.cache_folder)
+        self.assertEqual(store.get('a.cif'), CONTENT)
+        self.assertEqual(Handler.requests, [('/structures/a.cif', None),
+                                            ('/structures/a.cif', ETAG),
+                                            ('/structures/a.cif', ETAG)])
+
+    def test_memory_cache_lru(self):
+        store = ObjectStore(self.url, max_size=2)
+        for filename in ['a.cif', 'b.cif', 'a.cif', 'c.cif']:
+            store.get(filename)
+        self.assertEqual(len(Handler.requests), 3)
+        # b.cif was least recently used
+        store.get('a.cif')
+        self.assertEqual(len(Handler.requests), 3)
+        store.get('b.cif')
+        self.assertEqual(Handler.requests[-1], ('/structures/b.cif', None))
+        self.assertEqual(len(Handler.requests), 4)
+
+    def test_error_status(self):
+        store = ObjectStore(self.url, cache_folder=self.cache_folder)
+        for filename in ['missing.cif', 'error.cif']:
+            with self.assertRaises(requests.HTTPError):
+                store.get(filename)
+        # failed requests are not cached
+        with self.assertRaises(requests.HTTPError):
+            store.get('missing.cif')
+        self.assertEqual(len(Handler.requests), 3)
+
+    def test_reject_paths(self):
+        store = ObjectStore(self.url, cache_folder=self.cache_folder)
+        for filename in ['../a.cif', 'sub/a.cif', '/etc/passwd', '..', '']:
+            with self.assertRaises(ValueError):
+                store.get(filename)
+        self.assertEqual(Handler.requests, [])
+
+    def test_prefetch_failures(self):
+        store = ObjectStore(self.url)
+        prefetched = store._prefetched  # pylint: disable=protected-access
+        store.prefetch(['a.cif', 'missing.cif', '../a.cif'])
+        deadline = time.time() + 10
+        while len(prefetched) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        # failed files are prefetched again next time
+        self.assertEqual(prefetched, set(['a.cif']))
+
+
+if __name__ == '__main__':
+    unittest.main()